@@ -156,14 +156,20 @@ async function isServiceAvailable(serviceName, timeoutMs = 500) {
     }
     
     const statusData = await response.json();
-    const isBusy = statusData.busy === true;
+    // matrix-mult-service reports worker slots; other services only report busy
+    const isBusy = statusData.free_slots !== undefined
+      ? statusData.free_slots <= 0
+      : statusData.busy === true;
+    const capacity = statusData.free_slots !== undefined
+      ? `, free slots: ${statusData.free_slots}/${statusData.workers}, queued: ${statusData.queue_depth}`
+      : '';
     
     if (isBusy) {
-      console.log(`   ⚠️  ${serviceName}: Busy (status: ${statusData.status || 'unknown'})`);
+      console.log(`   ⚠️  ${serviceName}: Busy (status: ${statusData.status || 'unknown'}${capacity})`);
       return false;
     }
     
-    console.log(`   ✅ ${serviceName}: Available (not busy, status: ${statusData.status || 'ready'})`);
+    console.log(`   ✅ ${serviceName}: Available (not busy, status: ${statusData.status || 'ready'}${capacity})`);
     return true;
   } catch (error) {
     // Service doesn't exist, is unreachable, or timed out
@@ -534,6 +540,12 @@ app.use("/proxy", async (req, res, next) => {
     // strip the /proxy path
     req.url = req.url.replace(/^\/proxy/, "") 
 
+    // Let the service queue critical work ahead of carbon-aware batch work.
+    // Set on the incoming request, which the proxy forwards as is.
+    if (!req.headers['x-priority']) {
+      req.headers['x-priority'] = req.isCritical ? 'critical' : 'batch';
+    }
+
     return createProxyMiddleware({
       target,
       changeOrigin: true,
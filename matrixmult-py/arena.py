@@ -0,0 +1,77 @@
+import collections
+import contextlib
+
+import numpy as np
+
+import settings
+
+ALIGNMENT = 64
+
+
+def aligned_empty(shape, dtype, alignment=ALIGNMENT):
+    # Over-allocate raw bytes and start the array at the first aligned offset
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+# Per-worker pool of output buffers, bucketed by shape and dtype. Buffers
+# go back into the arena once a job is done with them, and the least
+# recently used buckets are dropped when the arena grows past max_bytes.
+class Arena:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.reused_bytes = 0
+        self.allocated_bytes = 0
+        self.evicted_bytes = 0
+        self._free = collections.OrderedDict()
+
+    def take(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype).str)
+        free = self._free.get(key)
+        if free:
+            array = free.pop()
+            if not free:
+                del self._free[key]
+            self.bytes -= array.nbytes
+            self.reused_bytes += array.nbytes
+            return array
+        array = aligned_empty(shape, dtype)
+        self.allocated_bytes += array.nbytes
+        return array
+
+    def give(self, array):
+        if array.nbytes > self.max_bytes:
+            return
+        key = (array.shape, array.dtype.str)
+        self._free.setdefault(key, []).append(array)
+        self._free.move_to_end(key)
+        self.bytes += array.nbytes
+        while self.bytes > self.max_bytes:
+            oldest, free = next(iter(self._free.items()))
+            evicted = free.pop(0)
+            if not free:
+                del self._free[oldest]
+            self.bytes -= evicted.nbytes
+            self.evicted_bytes += evicted.nbytes
+
+    @contextlib.contextmanager
+    def borrow(self, shape, dtype):
+        array = self.take(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.give(array)
+
+    def counters(self):
+        return {
+            "reused_bytes": self.reused_bytes,
+            "allocated_bytes": self.allocated_bytes,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+
+buffers = Arena(settings.OUTPUT_ARENA_BYTES)
@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+
+import operands
+import settings
+import strassen
+
+# Working sets for the bandwidth sweep: 32 KiB up to 256 MiB
+BANDWIDTH_BYTES = tuple(2**p for p in range(15, 29))
+
+
+def gemm_gflops(dtype, sizes=strassen.TUNING_SIZES, budget_seconds=0.5):
+    # BLAS rate at growing sizes, stopping before one product would exceed
+    # the budget, going by the last one scaled by n³
+    rng = np.random.default_rng(0)
+    rates = {}
+    seconds, last = 0.0, None
+    for n in sizes:
+        if last is not None and seconds * (n / last) ** 3 > budget_seconds:
+            break
+        a = rng.random((n, n), dtype=dtype)
+        b = rng.random((n, n), dtype=dtype)
+        seconds = strassen.best_time(lambda: a @ b)
+        rates[n] = 2 * n ** 3 / seconds / 1e9
+        last = n
+    return rates
+
+
+def bandwidth(sizes=BANDWIDTH_BYTES, min_seconds=0.02):
+    # Copy rate, reads plus writes, of a working set split between source
+    # and destination; repeated until a timing is long enough to trust
+    rates = {}
+    for nbytes in sizes:
+        if nbytes > settings.JOB_MEMORY_BUDGET // 2:
+            break
+        src = np.ones(nbytes // 16)
+        dst = np.empty_like(src)
+        # Fault the destination in before timing
+        np.copyto(dst, src)
+        reps = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(reps):
+                np.copyto(dst, src)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+            reps *= 2
+        rates[nbytes] = reps * 2 * src.nbytes / elapsed / 1e9
+    return rates
+
+
+def knee(rates):
+    # Largest working set still copied at 1.5 times the rate of the largest
+    # one; past it, streaming work runs at main-memory speed
+    sizes = sorted(rates)
+    inside = [nbytes for nbytes in sizes if rates[nbytes] >= 1.5 * rates[sizes[-1]]]
+    return inside[-1] if inside else None
+
+
+def generate_rate(dtype, side=2048):
+    # Elements per second the operand generator fills, timed on a fresh
+    # unseeded pair as an uncached job builds one
+    start = time.perf_counter()
+    operands.seeded_operands((side, side), (side, side), operands.new_seed(), dtype, cached=False)
+    return 2 * side * side / (time.perf_counter() - start)
+
+
+def calibrate(dtypes, gemm=None):
+    # `gemm` holds rates already measured, keyed by accumulation dtype name
+    gemm = dict(gemm or {})
+    for _, compute in dtypes.values():
+        name = np.dtype(compute).name
+        if name not in gemm:
+            gemm[name] = gemm_gflops(compute)
+    rates = bandwidth()
+    return {
+        "gemm_gflops": gemm,
+        "bandwidth_gbps": rates,
+        "knee_bytes": knee(rates),
+        "generate_rate": { np.dtype(storage).name: generate_rate(storage) for storage, _ in dtypes.values() },
+    }
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def optimal_order(dims):
+    # Classic O(k³) dynamic program over A1·…·Ak with Ai of shape
+    # dims[i-1] × dims[i]. Costs are scalar multiplications.
+    k = len(dims) - 1
+    cost = [[0] * k for _ in range(k)]
+    split = [[0] * k for _ in range(k)]
+    for length in range(2, k + 1):
+        for i in range(k - length + 1):
+            j = i + length - 1
+            cost[i][j] = None
+            for s in range(i, j):
+                c = cost[i][s] + cost[s + 1][j] + dims[i] * dims[s + 1] * dims[j + 1]
+                if cost[i][j] is None or c < cost[i][j]:
+                    cost[i][j] = c
+                    split[i][j] = s
+    return cost[0][k - 1], split
+
+
+def left_to_right_cost(dims):
+    return sum(dims[0] * dims[i] * dims[i + 1] for i in range(1, len(dims) - 1))
+
+
+def plan(dims):
+    # Products in evaluation order as (left, right, result) ids; ids below k
+    # are the inputs, k and up are intermediates.
+    k = len(dims) - 1
+    _, split = optimal_order(dims)
+    steps = []
+
+    def build(i, j):
+        if i == j:
+            return i, f"A{i + 1}"
+        left, left_text = build(i, split[i][j])
+        right, right_text = build(split[i][j] + 1, j)
+        steps.append((left, right, k + len(steps)))
+        return k + len(steps) - 1, f"({left_text} {right_text})"
+
+    _, text = build(0, k - 1)
+    return steps, text
+
+
+class BufferPool:
+    # Flat buffers of consumed intermediates, handed back out as views for
+    # later products so a chain allocates only when nothing free is big enough.
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+
+    def take(self, shape):
+        size = shape[0] * shape[1]
+        # By index: list.remove would compare arrays elementwise
+        fitting = [i for i, buf in enumerate(self.free) if buf.size >= size]
+        if fitting:
+            buf = self.free.pop(min(fitting, key=lambda i: self.free[i].size))
+            self.reused += 1
+        else:
+            buf = np.empty(size, dtype=self.dtype)
+            self.allocated += 1
+        return buf[:size].reshape(shape)
+
+    def give(self, array):
+        self.free.append(array.base if array.base is not None else array.reshape(-1))
+
+
+def execute(matrices, steps, dtype):
+    values = dict(enumerate(matrices))
+    pool = BufferPool(dtype)
+    k = len(matrices)
+    for left, right, result in steps:
+        a, b = values.pop(left), values.pop(right)
+        out = pool.take((a.shape[0], b.shape[1]))
+        np.matmul(a, b, out=out)
+        for consumed, index in ((a, left), (b, right)):
+            if index >= k:
+                pool.give(consumed)
+        values[result] = out
+    (product,) = values.values()
+    return product, pool
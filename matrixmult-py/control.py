@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class Preempted(Exception):
+    # Raised at a tile boundary when a job is asked to yield; `checkpoint`
+    # holds what a later run needs to resume it.
+    def __init__(self, checkpoint):
+        super().__init__("preempted")
+        self.checkpoint = checkpoint
+
+
+class Cancelled(Exception):
+    # Raised at a tile or block boundary once the job was cancelled or ran
+    # past its deadline; `discarded` describes the work thrown away.
+    def __init__(self, reason, discarded):
+        super().__init__(reason)
+        self.reason = reason
+        self.discarded = discarded
+
+
+# Requests from the pool to the job a worker is running. The worker's
+# receiver thread makes them; engines poll them between tiles and blocks,
+# the only points where a job can stop without losing its place. A request
+# names its job and is dropped unless that job is the one running, so it
+# can never land on the job that starts after it. Jobs the worker holds but
+# has not started are tracked too, so a cancel that reaches one of them
+# before it starts makes start() refuse it instead of being lost.
+class Control:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._preempt = threading.Event()
+        self._cancel = threading.Event()
+        self._queued = set()
+        self.job_id = None
+        self.deadline = None
+
+    def expect(self, job_id):
+        # `job_id` has been received and will come up for start()
+        with self._lock:
+            self._queued.add(job_id)
+
+    def start(self, job_id, deadline=None):
+        # False if the job was cancelled while it waited; it must not run
+        with self._lock:
+            if job_id not in self._queued:
+                return False
+            self._queued.discard(job_id)
+            self._preempt.clear()
+            self._cancel.clear()
+            self.job_id = job_id
+            self.deadline = deadline
+            return True
+
+    def preempt(self, job_id):
+        return self._request(self._preempt, job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            if job_id in self._queued:
+                self._queued.discard(job_id)
+                return True
+        return self._request(self._cancel, job_id)
+
+    def _request(self, event, job_id):
+        # True if `job_id` is running and was asked to stop
+        with self._lock:
+            if job_id != self.job_id:
+                return False
+            event.set()
+            return True
+
+    def reason(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            return "deadline exceeded"
+        if self._cancel.is_set():
+            return "cancelled"
+        return None
+
+    def check(self, done=0, total=1, flops=0):
+        # `done` of `total` units of a job worth `flops` are finished
+        reason = self.reason()
+        if reason is not None:
+            raise Cancelled(reason, {
+                "done": done,
+                "total": total,
+                "completed_fraction": done / total if total else 0.0,
+                "discarded_flops": int(flops * done / total) if total else 0,
+            })
+
+    def should_yield(self):
+        return self._preempt.is_set()
+
+
+job = Control()
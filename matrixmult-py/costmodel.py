@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+
+import settings
+import tiled
+from engine import DTYPES, choose_engine, dense_footprint, rowblock_rows
+
+
+def interpolate(points, x):
+    # Piecewise linear in log(x) through sorted (x, y) points, flat past the ends
+    if x <= points[0][0]:
+        return points[0][1]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if x <= x1:
+            return y0 + (y1 - y0) * math.log(x / x0) / math.log(x1 / x0)
+    return points[-1][1]
+
+
+def step(points, x):
+    # Value at the largest measured x not above `x`
+    below = [y for px, y in points if px <= x]
+    return below[-1] if below else points[0][1]
+
+
+# Predicted runtime, peak memory and energy of a job, from the calibration
+# the tuning task measured at startup on this pod:
+# - GEMM GFLOP/s against size, per accumulation dtype;
+# - copy bandwidth against working set, which drops past the cache knee;
+# - how fast operands are generated.
+# Until that calibration is in, nothing is predicted.
+class CostModel:
+    def __init__(self, tuning, threads, watts_per_core):
+        self.tuning = tuning
+        self.threads = threads
+        self.watts_per_core = watts_per_core
+        self._source = None
+
+    def _curves(self):
+        calibration = self.tuning.calibration
+        if not calibration:
+            return None
+        if self._source is not calibration:
+            points = lambda measured: sorted((int(x), y) for x, y in measured.items())
+            self._gemm = { dtype: points(rates) for dtype, rates in calibration["gemm_gflops"].items() }
+            self._bandwidth = points(calibration["bandwidth_gbps"])
+            self._source = calibration
+        return calibration
+
+    @property
+    def ready(self):
+        return self._curves() is not None
+
+    def gflops(self, size, compute):
+        return interpolate(self._gemm[np.dtype(compute).name], size)
+
+    def bandwidth(self, working_set):
+        return step(self._bandwidth, working_set)
+
+    def estimate(self, kind, params):
+        # None when uncalibrated or for work the model does not cover
+        # (sparse operands, uploads, batches and chains)
+        calibration = self._curves()
+        if calibration is None:
+            return None
+        if kind == "multiply" and params.get("density") is None:
+            shape = params["m"], params["k"], params["n"]
+            return self.product(calibration, *shape, params["dtype"], params["engine"], params.get("verify", 0))
+        if kind == "stream":
+            shape = params["m"], params["k"], params["n"]
+            return self.product(calibration, *shape, params["dtype"], "rowblock", block_rows=params["block_rows"])
+        if kind == "power":
+            return self.power(calibration, params["size"], params["exp"], params["dtype"])
+        return None
+
+    def seconds(self, kind, params):
+        estimate = self.estimate(kind, params)
+        return estimate and estimate["seconds"]
+
+    def product(self, calibration, m, k, n, dtype, engine="auto", verify=0, block_rows=None):
+        storage, compute = (np.dtype(t) for t in DTYPES[dtype])
+        engine = choose_engine(engine, m, k, n, dtype)
+        scratch = 0
+        # Widened copies of the operands, then one pass over C for the checksum
+        traffic = (m * k + k * n) * (storage.itemsize + compute.itemsize) if storage != compute else 0
+        traffic += m * n * compute.itemsize
+        if engine == "dense":
+            peak = dense_footprint(m, k, n, dtype)
+            rate = self.gflops((m * k * n) ** (1 / 3), compute)
+        elif engine == "rowblock":
+            rows = min(m, block_rows or rowblock_rows(k, n, compute))
+            # B stored and widened, one block of A and its output rows
+            peak = k * n * (storage.itemsize + compute.itemsize) + rows * (k + n) * compute.itemsize
+            rate = self.gflops((rows * k * n) ** (1 / 3), compute)
+        else:
+            tile = min(max(m, k, n), tiled.tile_size(settings.TILE_MEMORY_MB * 2**20, compute.itemsize))
+            peak = 4 * tile * tile * compute.itemsize
+            rate = self.gflops(tile, compute)
+            # Every output tile reads a row of A tiles and a column of B
+            # tiles back from the memory-mapped scratch files
+            traffic += (m * k * math.ceil(n / tile) + k * n * math.ceil(m / tile) + 2 * m * n) * storage.itemsize
+            scratch = (m * k + k * n + m * n) * storage.itemsize
+        if verify:
+            # Freivalds widens A, B and C to float64 a row chunk at a time
+            traffic += (m * k + k * n + m * n) * 2 * np.dtype(np.float64).itemsize
+        flops = 2 * m * k * n
+        return self.summary(calibration, f"{m},{k},{n}", dtype, engine, flops, rate, m * k + k * n, traffic, peak, scratch)
+
+    def power(self, calibration, size, exp, dtype):
+        storage, compute = (np.dtype(t) for t in DTYPES[dtype])
+        # A squaring for every bit after the leading one, plus a product per set bit
+        bits = bin(exp)[3:] if exp else ""
+        flops = 2 * size ** 3 * (len(bits) + bits.count("1"))
+        traffic = size * size * (storage.itemsize + 2 * compute.itemsize)
+        peak = 3 * size * size * compute.itemsize
+        rate = self.gflops(size, compute)
+        return self.summary(calibration, f"{size},{size},{size}", dtype, "dense", flops, rate, size * size, traffic, peak)
+
+    def summary(self, calibration, shape, dtype, engine, flops, rate, generated, traffic, peak, scratch=0):
+        storage = np.dtype(DTYPES[dtype][0]).name
+        timings = {
+            "generate_seconds": generated / calibration["generate_rate"][storage],
+            "compute_seconds": flops / (rate * 1e9),
+            "memory_seconds": traffic / (self.bandwidth(peak) * 1e9),
+        }
+        seconds = sum(timings.values())
+        return {
+            "shape": shape,
+            "dtype": dtype,
+            "engine": engine,
+            "flops": flops,
+            "seconds": seconds,
+            "gflops": flops / seconds / 1e9 if seconds else None,
+            "timings": timings,
+            "peak_bytes": peak,
+            "scratch_bytes": scratch,
+            "fits": peak <= settings.JOB_MEMORY_BUDGET,
+            "memory_bound": calibration["knee_bytes"] is not None and peak > calibration["knee_bytes"],
+            "threads": self.threads,
+            "energy_joules": seconds * self.threads * self.watts_per_core,
+        }
+
+    def to_dict(self):
+        calibration = self._curves()
+        if calibration is None:
+            return { "state": "pending" }
+        return { "state": "ready", "watts_per_core": self.watts_per_core, **calibration }
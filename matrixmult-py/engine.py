@@ -0,0 +1,578 @@
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import arena
+import calibration
+import chain
+import control
+import operands
+import settings
+import strassen
+import tiled
+import uploads
+import verify as verification
+
+ENGINES = ("auto", "dense", "tiled", "rowblock")
+ALGORITHMS = ("auto", "blas", "strassen")
+# Task kinds whose operands a worker may build ahead while another job runs
+PREFETCH_TASKS = ("multiply",)
+
+Preempted = control.Preempted
+Cancelled = control.Cancelled
+
+# Storage dtype of operands and result, and the dtype products accumulate in.
+# float16 only saves memory; BLAS has no half-precision GEMM, so tiles are
+# widened to float32 for the multiplication.
+DTYPES = {
+    "float64": (np.float64, np.float64),
+    "float32": (np.float32, np.float32),
+    "float16": (np.float16, np.float32),
+}
+
+
+class Stopwatch:
+    def __init__(self, timings=None):
+        self.timings = dict(timings or {})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = f"{name}_seconds"
+            self.timings[key] = self.timings.get(key, 0.0) + time.perf_counter() - start
+
+
+def gflops(flops, seconds):
+    return flops / seconds / 1e9 if seconds > 0 else None
+
+
+def dense_footprint(m, k, n, dtype="float64"):
+    storage, compute = (np.dtype(t).itemsize for t in DTYPES[dtype])
+    elements = m * k + k * n + m * n
+    if storage == compute:
+        return elements * storage
+    # Stored operands, their widened copies and the widened product
+    return (m * k + k * n) * (storage + compute) + m * n * compute
+
+
+def sparse_footprint(m, k, n, dtype, density):
+    # CSR/CSC operands, the copies the flop count converts them to, and the
+    # product at its expected fill-in: an entry of A·B is nonzero unless all
+    # k products feeding it miss, 1 - (1 - d²)^k for uniform nonzeros.
+    value = np.dtype(DTYPES[dtype][1]).itemsize
+    fill = -np.expm1(k * np.log1p(-density * density)) if density < 1 else 1.0
+    nnz = density * (m * k + k * n)
+    product_nnz = fill * m * n
+    index = 4 if max(nnz, product_nnz) < 2**31 else 8
+    return int((2 * nnz + product_nnz) * (value + index) + (2 * (m + k + n) + m) * index)
+
+
+def sparse_kernel(m, k, n, dtype, density):
+    # "sparse" below the threshold while the product's fill-in still leaves
+    # the sparse form smaller than the dense one, else "dense" if that fits;
+    # None when neither fits a job's memory.
+    sparse_bytes = sparse_footprint(m, k, n, dtype, density)
+    dense_bytes = dense_footprint(m, k, n, dtype)
+    sparse_fits = sparse_bytes <= settings.JOB_MEMORY_BUDGET
+    dense_fits = dense_bytes <= settings.JOB_MEMORY_BUDGET
+    if sparse_fits and density < settings.SPARSE_THRESHOLD and sparse_bytes < dense_bytes:
+        return "sparse"
+    if dense_fits:
+        return "dense"
+    return "sparse" if sparse_fits else None
+
+
+def precision(dtype):
+    storage, compute = (np.dtype(t) for t in DTYPES[dtype])
+    return {
+        "dtype": dtype,
+        "storage": storage.name,
+        "accumulate": compute.name,
+        "mantissa_bits": np.finfo(storage).nmant + 1,
+        "epsilon": float(np.finfo(storage).eps),
+    }
+
+
+def choose_engine(engine, m, k, n, dtype):
+    # Row blocks whenever B fits comfortably and either A is tall and skinny
+    # or the whole product would not fit; tiles on disk when even B is too big.
+    if engine != "auto":
+        return engine
+    fits = dense_footprint(m, k, n, dtype) <= settings.JOB_MEMORY_BUDGET
+    b_fits = 2 * k * n * np.dtype(DTYPES[dtype][1]).itemsize <= settings.JOB_MEMORY_BUDGET
+    tall = m >= settings.TALL_SKINNY_RATIO * max(k, n)
+    if b_fits and (tall or not fits):
+        return "rowblock"
+    return "dense" if fits else "tiled"
+
+
+def choose_algorithm(algorithm, m, k, n, crossover):
+    # auto only picks Strassen for square products where the startup tuning
+    # found a crossover and the size allows one level of recursion above it.
+    if algorithm == "auto":
+        return "strassen" if crossover and m == k == n and m >= 2 * crossover else "blas"
+    return algorithm
+
+
+_prefetcher = None
+def prefetcher():
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = ThreadPoolExecutor(1, thread_name_prefix="prefetch")
+    return _prefetcher
+
+
+def prefetch(kind, params):
+    # Called as a task reaches the worker. Returns a Future of the operands
+    # for dense multiplies small enough to hold two jobs' worth, else None.
+    if kind not in PREFETCH_TASKS or "checkpoint" in params:
+        return None
+    m, k, n, dtype = params["m"], params["k"], params["n"], params["dtype"]
+    if params["density"] is not None or choose_engine(params["engine"], m, k, n, dtype) != "dense":
+        return None
+    if dense_footprint(m, k, n, dtype) * (1 + settings.PREFETCH_DEPTH) > settings.JOB_MEMORY_BUDGET:
+        return None
+    return prefetcher().submit(generate_operands, m, k, n, params["seed"], dtype)
+
+
+def generate_operands(m, k, n, seed, dtype):
+    cached = seed is not None
+    if seed is None:
+        seed = operands.new_seed()
+    start = time.perf_counter()
+    a, b, cache = operands.seeded_operands((m, k), (k, n), seed, DTYPES[dtype][0], cached=cached)
+    return seed, a, b, cache, time.perf_counter() - start
+
+
+def multiply(report, m, k, n, engine="auto", seed=None, dtype="float64",
+             algorithm="blas", crossover=None, blas_gflops=None, density=None, verify=0,
+             prefetched=None, checkpoint=None):
+    if checkpoint is not None:
+        return multiply_tiled(report, m, k, n, checkpoint["seed"], dtype, verify, checkpoint)
+    cached = seed is not None and density is None
+    if seed is None:
+        seed = operands.new_seed()
+    if density is not None and sparse_kernel(m, k, n, dtype, density) == "sparse":
+        return multiply_sparse(report, m, k, n, seed, dtype, density, verify)
+    engine = choose_engine(engine, m, k, n, dtype)
+    if engine == "tiled":
+        return multiply_tiled(report, m, k, n, seed, dtype, verify)
+    if engine == "rowblock":
+        return multiply_rowblock(report, m, k, n, seed, dtype, verify)
+
+    storage, compute = DTYPES[dtype]
+    algorithm = choose_algorithm(algorithm, m, k, n, crossover)
+    crossover = crossover or strassen.DEFAULT_CROSSOVER
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        if prefetched is not None:
+            # Built while the previous job computed; only the rest is waited for
+            seed, a, b, cache, prefetch_seconds = prefetched.result()
+            clock.timings["prefetch_seconds"] = prefetch_seconds
+        elif density is None:
+            a, b, cache = operands.seeded_operands((m, k), (k, n), seed, storage, cached=cached)
+        else:
+            # Too dense to gain from a sparse kernel: same operands, dense GEMM
+            sparse_a, sparse_b = operands.sparse_operands((m, k), (k, n), seed, density, storage)
+            a, b = sparse_a.toarray(), sparse_b.toarray()
+            cache = { "hits": 0, "misses": 0 }
+    # One GEMM cannot be interrupted, so this is the last point to stop
+    control.job.check(0, 1, 2 * m * k * n)
+    checked = None
+    # A BLAS product's buffer goes back to the arena even if a stage fails
+    with contextlib.ExitStack() as buffers:
+        with clock.stage("compute"):
+            a = a.astype(compute, copy=False)
+            b = b.astype(compute, copy=False)
+            if algorithm == "strassen":
+                product = strassen.multiply(a, b, crossover)
+            else:
+                product = buffers.enter_context(arena.buffers.borrow((m, n), compute))
+                np.matmul(a, b, out=product)
+            checksum = float(product.sum(dtype=np.float64))
+        if verify:
+            with clock.stage("verify"):
+                checked = verification.Freivalds(b, verify, compute)
+                checked.check(a, product)
+    report(done=1, total=1)
+
+    summary = { **product_summary(m, k, n, "dense", seed, dtype, checksum, clock), "operand_cache": cache }
+    summary["prefetched"] = prefetched is not None
+    if checked is not None:
+        summary["verification"] = checked.result(compute)
+    summary["algorithm"] = { "name": algorithm }
+    if algorithm == "strassen":
+        summary["algorithm"]["crossover"] = crossover
+        summary["algorithm"]["levels"] = strassen.levels_for(m, crossover)
+        if blas_gflops:
+            # Estimated from the BLAS rate measured at startup, not a second run
+            blas_seconds = 2 * m * k * n / (blas_gflops * 1e9)
+            summary["algorithm"]["speedup_vs_blas"] = blas_seconds / clock.timings["compute_seconds"]
+    return summary
+
+
+def multiply_tiled(report, m, k, n, seed, dtype, verify=0, checkpoint=None):
+    # Preemptible between tiles: finished output tiles stay in the scratch
+    # directory, and the checkpoint lets any worker carry on from there.
+    storage, compute = DTYPES[dtype]
+    tile = min(max(m, k, n), tiled.tile_size(settings.TILE_MEMORY_MB * 2**20, np.dtype(compute).itemsize))
+    resume = checkpoint or {}
+    preemptions = resume.get("preemptions", 0)
+    clock = Stopwatch(resume.get("timings"))
+    with tiled.scratch_space(settings.SCRATCH_DIR, resume.get("scratch")) as scratch:
+        with clock.stage("generate"):
+            if checkpoint is None:
+                seed_a, seed_b = operands.operand_seeds(seed)
+                a = tiled.scratch_matrix(scratch, "a", (m, k), storage)
+                b = tiled.scratch_matrix(scratch, "b", (k, n), storage)
+                out = tiled.scratch_matrix(scratch, "out", (m, n), storage)
+                operands.random_matrix(a.shape, seed_a, out=a)
+                operands.random_matrix(b.shape, seed_b, out=b)
+            else:
+                a, b, out = (tiled.open_scratch(scratch, name) for name in ("a", "b", "out"))
+        try:
+            with clock.stage("compute"):
+                checksum = tiled.blocked_matmul(a, b, out, tile, report, compute, resume.get("cursor", 0),
+                                                resume.get("checksum", 0.0), control.job)
+        except Preempted as e:
+            e.checkpoint.update(scratch=scratch, seed=seed, timings=clock.timings, preemptions=preemptions + 1)
+            raise
+        summary = { **product_summary(m, k, n, "tiled", seed, dtype, checksum, clock), "tile": tile,
+                    "preemptions": preemptions }
+        if verify:
+            with clock.stage("verify"):
+                checked = verification.Freivalds(b, verify, compute)
+                checked.check(a, out)
+            summary["verification"] = checked.result(storage)
+    return summary
+
+
+def rowblock_rows(k, n, dtype):
+    # Rows of A plus the matching output rows that fit the tile working set
+    return max(1, settings.TILE_MEMORY_MB * 2**20 // ((k + n) * np.dtype(dtype).itemsize))
+
+
+def rowblock_product(a_blocks, b, rows, block_rows, compute, clock, report, sink=None, checked=None):
+    # A is generated block by block and never held whole; B stays resident.
+    # Generated blocks follow the generator's chunking, which may be far
+    # taller than block_rows, so each is multiplied block_rows rows at a time.
+    # Every slice's output lands in one reused buffer, then in `sink` if
+    # given, and is verified against its rows of A while both are at hand.
+    b = b.astype(compute, copy=False)
+    buffer = None
+    checksum = 0.0
+    try:
+        while True:
+            with clock.stage("generate"):
+                item = next(a_blocks, None)
+            if item is None:
+                return checksum
+            first_row, block = item
+            for offset in range(0, len(block), block_rows):
+                start = first_row + offset
+                part = block[offset:offset + block_rows]
+                control.job.check(start, rows, 2 * rows * b.shape[0] * b.shape[1])
+                with clock.stage("compute"):
+                    if buffer is None:
+                        buffer = arena.buffers.take((min(block_rows, rows), b.shape[1]), compute)
+                    out = buffer[:len(part)]
+                    np.matmul(part.astype(compute, copy=False), b, out=out)
+                    if sink is not None:
+                        sink[start:start + len(part)] = out
+                    checksum += float(out.sum(dtype=np.float64))
+                if checked is not None:
+                    with clock.stage("verify"):
+                        checked.check(part, out)
+                report(done=start + len(part), total=rows, flops=2 * (start + len(part)) * b.shape[0] * b.shape[1])
+    finally:
+        if buffer is not None:
+            arena.buffers.give(buffer)
+
+
+def multiply_rowblock(report, m, k, n, seed, dtype, verify=0):
+    storage, compute = DTYPES[dtype]
+    block_rows = rowblock_rows(k, n, compute)
+    seed_a, seed_b = operands.operand_seeds(seed)
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        b = operands.random_matrix((k, n), seed_b, storage)
+        a_blocks = operands.random_row_blocks((m, k), seed_a, storage, block_rows)
+    checked = verification.Freivalds(b, verify, compute) if verify else None
+    checksum = rowblock_product(a_blocks, b, m, block_rows, compute, clock, report, checked=checked)
+
+    summary = { **product_summary(m, k, n, "rowblock", seed, dtype, checksum, clock), "block_rows": block_rows }
+    if checked is not None:
+        summary["verification"] = checked.result(compute)
+    return summary
+
+
+def multiply_sparse(report, m, k, n, seed, dtype, density, verify=0):
+    # scipy.sparse has no float16 kernels, so half precision is held as float32.
+    compute = DTYPES[dtype][1]
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        a, b = operands.sparse_operands((m, k), (k, n), seed, density, compute)
+    with clock.stage("compute"):
+        product = a @ b
+        checksum = float(product.sum(dtype=np.float64))
+    checked = None
+    if verify:
+        with clock.stage("verify"):
+            checked = verification.Freivalds(b, verify, compute)
+            checked.check(a, product)
+    report(done=1, total=1)
+
+    # Multiply-adds actually performed: column k of A meets row k of B
+    flops = 2 * int(np.dot(np.diff(a.tocsc().indptr).astype(np.int64), np.diff(b.tocsr().indptr)))
+    sparse_bytes = sum(operands.sparse_nbytes(m) for m in (a, b, product))
+    dense_bytes = (m * k + k * n + m * n) * np.dtype(DTYPES[dtype][0]).itemsize
+    summary = product_summary(m, k, n, "sparse", seed, dtype, checksum, clock, flops=flops)
+    summary["sparse"] = {
+        "density": density,
+        "nnz": { "a": a.nnz, "b": b.nnz, "product": product.nnz },
+        "bytes": sparse_bytes,
+        "dense_bytes": dense_bytes,
+        "memory_saved_bytes": dense_bytes - sparse_bytes,
+    }
+    if checked is not None:
+        summary["verification"] = checked.result(compute)
+    return summary
+
+
+def product_summary(m, k, n, engine, seed, dtype, checksum, clock, flops=None):
+    if flops is None:
+        flops = 2 * m * k * n
+    return {
+        "size": f"{m},{n}",
+        "shape": f"{m},{k},{n}",
+        "engine": engine,
+        "seed": seed,
+        "precision": precision(dtype),
+        "checksum": checksum,
+        "flops": flops,
+        "gflops": gflops(flops, clock.timings["compute_seconds"]),
+        "timings": clock.timings,
+    }
+
+
+def batch(report, dtype="float64", results=False, count=None, size=None, seed=None, a=None, b=None):
+    # A stack of small products in one vectorized matmul: either `count`
+    # seeded size×size pairs, or uploaded (count, m, k) and (count, k, n) stacks.
+    storage, compute = DTYPES[dtype]
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        if a is None:
+            if seed is None:
+                seed = operands.new_seed()
+            shape = (count, size, size)
+            a, b, _ = operands.seeded_operands(shape, shape, seed, storage, cached=False)
+    with clock.stage("compute"):
+        products = np.matmul(a.astype(compute, copy=False), b.astype(compute, copy=False))
+        checksums = products.sum(axis=(1, 2), dtype=np.float64)
+    report(done=1, total=1)
+
+    count, m, k = a.shape
+    flops = 2 * count * m * k * b.shape[2]
+    summary = {
+        "count": count,
+        "shape": f"{m},{k},{b.shape[2]}",
+        "engine": "batch",
+        "seed": seed,
+        "precision": precision(dtype),
+        "checksums": checksums.tolist(),
+        "flops": flops,
+        "gflops": gflops(flops, clock.timings["compute_seconds"]),
+        "timings": clock.timings,
+    }
+    if results:
+        summary["results"] = products.astype(storage, copy=False).tolist()
+    return summary
+
+
+def multiply_stream(report, m, k, n, out_path, block_rows, seed=None, dtype="float64"):
+    # Row blocks of the product are written to a raw file in order, and each
+    # completed block is reported so the server can stream it out while the
+    # next one is computed.
+    storage, compute = DTYPES[dtype]
+    if seed is None:
+        seed = operands.new_seed()
+    seed_a, seed_b = operands.operand_seeds(seed)
+    clock = Stopwatch()
+    with tiled.scratch_space(settings.SCRATCH_DIR) as scratch:
+        with clock.stage("generate"):
+            if k * n * np.dtype(storage).itemsize <= settings.JOB_MEMORY_BUDGET // 2:
+                b = operands.random_matrix((k, n), seed_b, storage)
+            else:
+                b = operands.random_matrix((k, n), seed_b, out=tiled.scratch_matrix(scratch, "b", (k, n), storage))
+            a_blocks = operands.random_row_blocks((m, k), seed_a, storage, block_rows)
+            out = np.memmap(out_path, dtype=np.dtype(storage).newbyteorder("<"), mode="w+", shape=(m, n))
+        checksum = rowblock_product(a_blocks, b, m, block_rows, compute, clock, report, sink=out)
+        del out
+
+    return { **product_summary(m, k, n, "stream", seed, dtype, checksum, clock), "block_rows": block_rows }
+
+
+def multiply_files(report, path, a, b, out_path, out_format, verify=0):
+    # Operands are mapped from the uploaded file and the product is written
+    # into a mapped result file, so neither crosses the worker pipe.
+    dtype = np.dtype(a["dtype"]).name
+    storage, compute = DTYPES[dtype]
+    clock = Stopwatch()
+    with clock.stage("decode"):
+        a = uploads.map_operand(path, a)
+        b = uploads.map_operand(path, b)
+        shape = (a.shape[0], b.shape[1])
+        if out_format == "npy":
+            out = np.lib.format.open_memmap(out_path, mode="w+", dtype=storage, shape=shape)
+        else:
+            out = np.memmap(out_path, dtype=np.dtype(storage).newbyteorder("<"), mode="w+", shape=shape)
+    with clock.stage("compute"):
+        if storage == compute:
+            np.matmul(a, b, out=out)
+        else:
+            out[...] = np.matmul(a.astype(compute), b.astype(compute))
+        checksum = float(out.sum(dtype=np.float64))
+        out.flush()
+    checked = None
+    if verify:
+        with clock.stage("verify"):
+            checked = verification.Freivalds(b, verify, compute)
+            checked.check(a, out)
+    report(done=1, total=1)
+
+    flops = 2 * a.shape[0] * a.shape[1] * b.shape[1]
+    summary = {
+        "shape": f"{a.shape[0]},{a.shape[1]},{b.shape[1]}",
+        "engine": "upload",
+        "precision": precision(dtype),
+        "checksum": checksum,
+        "flops": flops,
+        "gflops": gflops(flops, clock.timings["compute_seconds"]),
+        "timings": clock.timings,
+    }
+    if checked is not None:
+        summary["verification"] = checked.result(storage)
+    return summary
+
+
+def multiply_chain(report, dims, seed=None, dtype="float64"):
+    storage, compute = DTYPES[dtype]
+    if seed is None:
+        seed = operands.new_seed()
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        streams = operands.operand_seeds(seed, len(dims) - 1)
+        matrices = [
+            operands.random_matrix((dims[i], dims[i + 1]), stream, storage).astype(compute, copy=False)
+            for i, stream in enumerate(streams)
+        ]
+    with clock.stage("plan"):
+        steps, order = chain.plan(dims)
+        flops = 2 * chain.optimal_order(dims)[0]
+    with clock.stage("compute"):
+        product, buffers = chain.execute(matrices, steps, compute)
+        checksum = float(product.sum(dtype=np.float64))
+    report(done=1, total=1)
+
+    naive_flops = 2 * chain.left_to_right_cost(dims)
+    return {
+        "dims": dims,
+        "shape": f"{dims[0]},{dims[-1]}",
+        "engine": "chain",
+        "seed": seed,
+        "precision": precision(dtype),
+        "order": order,
+        "checksum": checksum,
+        "flops": flops,
+        "left_to_right_flops": naive_flops,
+        "flops_saved": naive_flops - flops,
+        "buffers": { "allocated": buffers.allocated, "reused": buffers.reused },
+        "gflops": gflops(flops, clock.timings["compute_seconds"]),
+        "timings": clock.timings,
+    }
+
+
+def power(report, size, exp, seed=None, dtype="float64"):
+    # A^exp by left-to-right binary exponentiation: square for every bit after
+    # the leading one and multiply by A where the bit is set. Products go back
+    # and forth between two preallocated buffers, so no step allocates.
+    storage, compute = DTYPES[dtype]
+    if seed is None:
+        seed = operands.new_seed()
+    clock = Stopwatch()
+    with clock.stage("generate"):
+        seed_a, = operands.operand_seeds(seed, 1)
+        a = operands.random_matrix((size, size), seed_a, storage).astype(compute)
+        # Row-stochastic, like a Markov transition matrix, so powers stay finite
+        a /= a.sum(axis=1, keepdims=True)
+    bits = bin(exp)[3:] if exp else ""
+    multiplications = 0
+    with arena.buffers.borrow(a.shape, compute) as current, arena.buffers.borrow(a.shape, compute) as spare:
+        with clock.stage("compute"):
+            if exp == 0:
+                current[...] = 0
+                np.fill_diagonal(current, 1)
+            else:
+                current[...] = a
+            for done, bit in enumerate(bits, 1):
+                control.job.check(done - 1, len(bits), 2 * size ** 3 * (len(bits) + bits.count("1")))
+                np.matmul(current, current, out=spare)
+                current, spare = spare, current
+                multiplications += 1
+                if bit == "1":
+                    np.matmul(current, a, out=spare)
+                    current, spare = spare, current
+                    multiplications += 1
+                report(done=done, total=len(bits), flops=2 * size ** 3 * multiplications)
+            checksum = float(current.sum(dtype=np.float64))
+
+    flops = 2 * size ** 3 * multiplications
+    return {
+        "size": f"{size},{size}",
+        "exp": exp,
+        "engine": "power",
+        "seed": seed,
+        "precision": precision(dtype),
+        "multiplications": multiplications,
+        "checksum": checksum,
+        "flops": flops,
+        "gflops": gflops(flops, clock.timings["compute_seconds"]),
+        "timings": clock.timings,
+    }
+
+
+def tune(report, dtype="float64"):
+    # Strassen crossover, and the BLAS rates calibrate() then reuses
+    return strassen.tune(DTYPES[dtype][1])
+
+
+def calibrate(report, gemm=None):
+    # The rest of the cost model's calibration; `gemm` holds BLAS rates
+    # already measured, by accumulation dtype name
+    return { "calibration": calibration.calibrate(DTYPES, gemm) }
+
+
+TASKS = {
+    "tune": tune,
+    "calibrate": calibrate,
+    "multiply": multiply,
+    "batch": batch,
+    "upload": multiply_files,
+    "stream": multiply_stream,
+    "chain": multiply_chain,
+    "power": power,
+}
+
+
+def run(kind, params, report, prefetched=None):
+    if prefetched is not None:
+        params = { **params, "prefetched": prefetched }
+    before = arena.buffers.counters()
+    result = TASKS[kind](report, **params)
+    after = arena.buffers.counters()
+    return { **result, "output_arena": { key: after[key] - before[key] for key in after } }
@@ -0,0 +1,295 @@
+import collections
+import threading
+import time
+import uuid
+
+from pool import PRIORITIES, JobCancelled, JobFailed, PoolFull
+
+
+class Overloaded(PoolFull):
+    # The cost model predicts the job would finish after `limit_seconds`
+    def __init__(self, predicted_seconds, limit_seconds):
+        super().__init__(f"predicted to finish in {predicted_seconds:.3g}s, limit {limit_seconds:.3g}s")
+        self.predicted_seconds = predicted_seconds
+        self.limit_seconds = limit_seconds
+
+
+def operand_free(params):
+    # Params without the operand arrays uploaded with them
+    return { key: value for key, value in params.items() if not hasattr(value, "shape") }
+
+
+class Job:
+    def __init__(self, kind, params, priority="normal"):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.priority = priority
+        self.state = "queued"
+        self.progress = 0.0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.preemptions = 0
+        self.discarded = None
+        # Submissions sharing the job, and the key they were coalesced on
+        self.waiters = 1
+        self.key = None
+        # Runtime the cost model predicted at submission, if it covers the job
+        self.predicted_seconds = None
+        # Last progress report from the worker and when it arrived; waiters
+        # on `updated` are woken on every event.
+        self.detail = {}
+        self.reported_at = None
+        self.updated = threading.Condition()
+        # Bumped on every event, so streams can tell what they have sent
+        self.version = 0
+        # Progress when the job last (re)started running, to extrapolate from
+        self.resumed_at = None
+        self.resumed_progress = 0.0
+
+    def on_event(self, event, data):
+        with self.updated:
+            if event == "started":
+                self.state = "running"
+                # Resuming after a preemption keeps the first start time
+                self.started_at = self.started_at or time.time()
+                self.resumed_at = time.time()
+                self.resumed_progress = self.progress
+            elif event == "preempted":
+                self.state = "preempted"
+                self.preemptions += 1
+            elif event == "progress" and data.get("total"):
+                self.detail = data
+                self.reported_at = time.time()
+                self.progress = data["done"] / data["total"]
+            self.version += 1
+            self.updated.notify_all()
+
+    def on_done(self, future):
+        with self.updated:
+            self.finished_at = time.time()
+            try:
+                self.result = future.result()
+                self.state = "done"
+                self.progress = 1.0
+            except JobCancelled as e:
+                self.error = e.reason
+                self.discarded = e.discarded
+                self.state = "cancelled"
+            except JobFailed as e:
+                self.error = str(e)
+                self.state = "failed"
+            self.version += 1
+            self.updated.notify_all()
+
+    def estimate(self):
+        # Time left, extrapolated from the progress made since the job last
+        # started running; None until there is progress to go on
+        with self.updated:
+            if self.state != "running":
+                return None
+            elapsed = time.time() - self.resumed_at
+            gained = self.progress - self.resumed_progress
+            return {
+                "done": self.detail.get("done", 0),
+                "total": self.detail.get("total"),
+                "progress": round(self.progress, 4),
+                "elapsed_seconds": elapsed,
+                "eta_seconds": elapsed * (1 - self.progress) / gained if gained > 0 else None,
+                "flops": self.detail.get("flops"),
+                "reported_at": self.reported_at,
+            }
+
+    def discarded_now(self):
+        # What stopping the job now would throw away, going by the last
+        # progress report
+        with self.updated:
+            done = self.detail.get("done", 0)
+            total = self.detail.get("total") or 1
+            return {
+                "done": done,
+                "total": total,
+                "completed_fraction": done / total,
+                "discarded_flops": self.detail.get("flops") or 0,
+                "seconds": time.time() - self.started_at if self.started_at else 0.0,
+            }
+
+    def remaining(self):
+        # Seconds of work left: extrapolated from progress while running,
+        # otherwise what the cost model predicted for the part not yet done
+        estimate = self.estimate()
+        if estimate is not None and estimate["eta_seconds"] is not None:
+            return estimate["eta_seconds"]
+        if self.predicted_seconds is None:
+            return None
+        return self.predicted_seconds * (1 - self.progress)
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def to_dict(self):
+        now = time.time()
+        started = self.started_at or now
+        info = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "params": operand_free(self.params),
+            "priority": self.priority,
+            "critical": self.priority == "critical",
+            "state": self.state,
+            "progress": round(self.progress, 4),
+            "preemptions": self.preemptions,
+            "waiters": self.waiters,
+            "predicted_seconds": self.predicted_seconds,
+            "timings": {
+                "submitted_at": self.submitted_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "queue_seconds": started - self.submitted_at,
+                "run_seconds": (self.finished_at or now) - started if self.started_at else 0.0,
+            },
+        }
+        if self.error is not None:
+            info["error"] = self.error
+        if self.discarded is not None:
+            info["discarded"] = self.discarded
+        return info
+
+
+class JobTable:
+    def __init__(self, pool, ttl, max_queue, critical_threads, on_finished=None, on_coalesced=None,
+                 estimate=None, admission_seconds=0.0):
+        self.pool = pool
+        # estimate(kind, params) -> predicted seconds or None
+        self.estimate = estimate
+        self.admission_seconds = admission_seconds
+        self.critical_threads = critical_threads
+        self.on_finished = on_finished
+        self.on_coalesced = on_coalesced
+        self.ttl = ttl
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._finished = collections.deque()
+        self._in_flight = {}
+
+    def submit(self, kind, params, max_queue=None, priority="normal", key=None, deadline=None):
+        # Submissions with the same key while a job for it is queued or
+        # running share that job instead of computing the result again.
+        with self._lock:
+            shared = self._in_flight.get(key) if key is not None else None
+            if shared is None:
+                job = Job(kind, params, priority)
+                job.key = key
+                job.predicted_seconds = self.estimate(kind, params) if self.estimate else None
+                self._admit(job, deadline)
+                job.future = self.pool.submit(
+                    kind,
+                    params,
+                    listener=job.on_event,
+                    max_queue=self.max_queue if max_queue is None else max_queue,
+                    threads=self.critical_threads if priority == "critical" else None,
+                    priority=priority,
+                    deadline=deadline,
+                )
+                # Uploaded operands now belong to the pool; the table keeps
+                # the job for its TTL and must not hold them that long
+                job.params = operand_free(params)
+                self._evict()
+                self._jobs[job.id] = job
+                if key is not None:
+                    self._in_flight[key] = job
+            else:
+                shared.waiters += 1
+        if shared is not None:
+            if self.on_coalesced is not None:
+                self.on_coalesced(shared)
+            return shared
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        return job
+
+    def cancel(self, job_id, reason="cancelled"):
+        # A shared job is computed for every submission that joined it, so
+        # it is only stopped once each of them has cancelled
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.waiters -= 1
+            if job.waiters > 0:
+                return job
+            # Later submissions must not join a job that is being stopped
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+        self.pool.cancel(job.future, reason)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            states = collections.Counter(job.state for job in self._jobs.values())
+            running = [job for job in self._jobs.values() if job.state == "running"]
+            backlog = self._backlog()
+        etas = [eta for eta in map(Job.remaining, running) if eta is not None]
+        return {
+            "jobs": dict(states),
+            "job_ttl_seconds": self.ttl,
+            # Soonest a running job is expected to finish and free its worker
+            "next_finish_seconds": min(etas, default=None),
+            # Predicted seconds until every worker has worked off its share
+            # of the running and queued jobs
+            "backlog_seconds": backlog,
+        }
+
+    def backlog(self, priority=None):
+        with self._lock:
+            return self._backlog(priority)
+
+    def _backlog(self, priority=None):
+        # Caller holds self._lock. Remaining work of running jobs and of the
+        # queued ones not in a lower class than `priority`, spread over the
+        # workers; jobs the model has no estimate for count as none.
+        rank = PRIORITIES.index(priority) if priority else len(PRIORITIES)
+        ahead = [job for job in self._jobs.values() if job.state == "running"
+                 or not job.finished and PRIORITIES.index(job.priority) <= rank]
+        return sum(job.remaining() or 0.0 for job in ahead) / self.pool.size
+
+    def _admit(self, job, deadline):
+        # Caller holds self._lock
+        if job.predicted_seconds is None:
+            return
+        limits = [deadline - time.time()] if deadline is not None else []
+        if self.admission_seconds:
+            limits.append(self.admission_seconds)
+        if not limits:
+            return
+        finish = self._backlog(job.priority) + job.predicted_seconds
+        if finish > min(limits):
+            raise Overloaded(finish, min(limits))
+
+    def _on_done(self, job, future):
+        job.on_done(future)
+        with self._lock:
+            self._finished.append(job)
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+        if self.on_finished is not None:
+            self.on_finished(job)
+
+    def _evict(self):
+        # Caller holds self._lock. Jobs finish roughly in order, so expired
+        # ones collect at the left of the deque.
+        cutoff = time.time() - self.ttl
+        while self._finished and self._finished[0].finished_at < cutoff:
+            self._jobs.pop(self._finished.popleft().id, None)
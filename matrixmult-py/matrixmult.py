@@ -1,32 +1,587 @@
-from flask import Flask, request, jsonify
-import numpy as np
+import io
+import json
+import os
 import time
+from concurrent import futures
+
+import numpy as np
+from flask import Flask, Response, request, jsonify, send_file, url_for
+from werkzeug.serving import WSGIRequestHandler
+
+import settings
+import uploads
+import verify
+from costmodel import CostModel
+from engine import ALGORITHMS, DTYPES, ENGINES, PREFETCH_TASKS, TASKS, sparse_kernel
+from jobs import JobTable, Overloaded
+from metrics import Registry, size_bucket
+from pool import PRIORITIES, WorkerPool, PoolFull, JobCancelled, JobFailed
+from tuning import Tuning, fingerprint
 
 app = Flask(__name__)
 
-busy = False
+registry = Registry()
+stage_seconds = registry.histogram("matrixmult_stage_seconds", "Time spent per request stage.")
+gflops_rate = registry.summary("matrixmult_gflops", "Achieved GFLOP/s of the multiplication.")
+jobs_total = registry.counter("matrixmult_jobs_total", "Finished jobs by outcome.")
+pool_gauge = registry.gauge("matrixmult_pool", "Worker pool occupancy.")
+operand_cache = registry.counter("matrixmult_operand_cache_total", "Operand cache lookups by result.")
+queue_wait = registry.histogram("matrixmult_queue_wait_seconds", "Time jobs waited for a worker, by priority class.")
+discarded_flops = registry.counter("matrixmult_discarded_flops_total", "Work thrown away by cancelled jobs, by reason.")
+coalesced = registry.counter("matrixmult_coalesced_total", "Requests served by an identical job already in flight.")
+output_arena = registry.counter("matrixmult_output_arena_bytes_total", "Output buffer bytes reused from or newly allocated by the worker arenas.")
+
+def job_size(job):
+    # Edge of the square product with the same flop count, so rectangular,
+    # batched and uploaded jobs share the size buckets of /multiply.
+    if job.result and job.result.get("flops"):
+        return round((job.result["flops"] / 2) ** (1 / 3))
+    return job.params.get("m", job.params.get("size", 0))
+
+def record_job(job):
+    bucket = size_bucket(job_size(job))
+    jobs_total.inc(state=job.state, size_bucket=bucket)
+    if job.state == "cancelled":
+        discarded_flops.inc(job.discarded["discarded_flops"], reason=job.error)
+    if job.state != "done":
+        return
+    for result in ("hits", "misses"):
+        operand_cache.inc(job.result.get("operand_cache", {}).get(result, 0), result=result)
+    for result in ("reused", "allocated", "evicted"):
+        output_arena.inc(job.result.get("output_arena", {}).get(f"{result}_bytes", 0), result=result)
+    stage_seconds.observe(job.started_at - job.submitted_at, stage="queue", size_bucket=bucket)
+    queue_wait.observe(job.started_at - job.submitted_at, priority=job.priority)
+    for key, seconds in job.result["timings"].items():
+        stage_seconds.observe(seconds, stage=key.removesuffix("_seconds"), size_bucket=bucket)
+    if job.result.get("gflops"):
+        gflops_rate.observe(job.result["gflops"], engine=job.result["engine"],
+                            dtype=job.result["precision"]["dtype"], size_bucket=bucket)
+
+@registry.on_collect
+def collect_pool():
+    stats = pool.stats()
+    for priority, depth in stats.pop("queue_depth_by_priority").items():
+        pool_gauge.set(depth, field="queue_depth", priority=priority)
+    for key, value in stats.items():
+        pool_gauge.set(value, field=key)
+
+pool = WorkerPool(settings.WORKERS, settings.BLAS_THREADS, settings.QUEUE_SIZE, settings.CRITICAL_THREADS,
+                  settings.PREFETCH_DEPTH, PREFETCH_TASKS, settings.PRIORITY_AGING_SECONDS, settings.PROGRESS_INTERVAL)
+tuning = Tuning(settings.TUNING_FILE, fingerprint(settings.CPU_LIMIT, settings.BLAS_THREADS))
+cost = CostModel(tuning, settings.BLAS_THREADS, settings.WATTS_PER_CORE)
+jobs = JobTable(pool, settings.JOB_TTL, settings.JOB_QUEUE_SIZE, settings.CRITICAL_THREADS,
+                on_finished=record_job, on_coalesced=lambda job: coalesced.inc(kind=job.kind),
+                estimate=cost.seconds, admission_seconds=settings.ADMISSION_SECONDS)
+spool = uploads.SpoolBudget(settings.MAX_SPOOL_BYTES)
+
+def request_params():
+    # Query string, overridden by a JSON body when one is sent
+    params = request.args.to_dict()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    return params
+
+def priority_param(params):
+    # X-Priority header or ?priority=; without either, the dispatcher's
+    # ?critical=true|1 marks critical work
+    priority = request.headers.get("X-Priority") or params.get("priority")
+    if not priority:
+        return "critical" if is_true(params.get("critical", "")) else "normal"
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+    return priority
+
+def is_true(value):
+    return str(value).lower() in ("true", "1")
+
+def deadline_param(params):
+    # deadline_ms from now, as wall-clock time; past it the job is abandoned
+    deadline_ms = params.get("deadline_ms")
+    if deadline_ms in (None, ""):
+        return None
+    deadline_ms = float(deadline_ms)
+    if deadline_ms <= 0:
+        raise ValueError("deadline_ms must be positive")
+    return time.time() + deadline_ms / 1000
+
+def dtype_param(params):
+    dtype = params.get("dtype", "float64")
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {', '.join(DTYPES)}")
+    return dtype
+
+def verify_param(params):
+    # Freivalds rounds to check the product with; 0 skips verification
+    rounds = int(params.get("verify") or 0)
+    if not 0 <= rounds <= verify.MAX_ROUNDS:
+        raise ValueError(f"verify must be between 0 and {verify.MAX_ROUNDS} rounds")
+    return rounds
+
+def seed_param(params):
+    seed = params.get("seed")
+    if seed in (None, ""):
+        return None
+    seed = int(seed)
+    if seed < 0:
+        raise ValueError("seed must be a non-negative integer")
+    return seed
+
+def multiply_params(params):
+    engine = params.get("engine", "auto")
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {', '.join(ENGINES)}")
+    algorithm = params.get("algorithm", "auto")
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"algorithm must be one of {', '.join(ALGORITHMS)}")
+    # (m×k)·(k×n); each dimension defaults to size for square products
+    size = int(params.get("size", 2000))
+    m, k, n = (size if params.get(dim) in (None, "") else int(params[dim]) for dim in ("m", "k", "n"))
+    if min(m, k, n) < 1:
+        raise ValueError("m, k and n must be positive")
+    if algorithm == "strassen" and not m == k == n:
+        raise ValueError("algorithm=strassen needs a square product (m = k = n)")
+    density = params.get("density")
+    if density not in (None, ""):
+        density = float(density)
+        if not 0 < density <= 1:
+            raise ValueError("density must be in (0, 1]")
+    else:
+        density = None
+    dtype = dtype_param(params)
+    if density is not None and sparse_kernel(m, k, n, dtype, density) is None:
+        raise ValueError(f"a product of density {density} would not fit the "
+                         f"{settings.JOB_MEMORY_BUDGET} bytes a job may use, sparse or dense")
+    return {
+        "m": m,
+        "k": k,
+        "n": n,
+        "density": density,
+        "engine": engine,
+        "seed": seed_param(params),
+        "dtype": dtype,
+        "algorithm": algorithm,
+        "crossover": tuning.crossover,
+        "blas_gflops": tuning.blas_gflops(round((m * k * n) ** (1 / 3)), DTYPES[dtype][1]),
+        "verify": verify_param(params),
+    }
+
+def batch_params(params):
+    dtype = dtype_param(params)
+    storage = np.dtype(DTYPES[dtype][0])
+    if "a" in params or "b" in params:
+        a = np.asarray(params.get("a"), dtype=storage)
+        b = np.asarray(params.get("b"), dtype=storage)
+        if a.ndim != 3 or b.ndim != 3 or a.shape[0] != b.shape[0] or a.shape[2] != b.shape[1]:
+            raise ValueError("a and b must be stacks of shape (count, m, k) and (count, k, n)")
+        batch = { "a": a, "b": b }
+        count, rows, cols = a.shape[0], a.shape[1], b.shape[2]
+        footprint = a.nbytes + b.nbytes + count * rows * cols * storage.itemsize
+    else:
+        count = int(params.get("count", 1000))
+        rows = cols = int(params.get("size", 64))
+        if count < 1 or rows < 1:
+            raise ValueError("count and size must be positive")
+        batch = { "count": count, "size": rows, "seed": seed_param(params) }
+        footprint = 3 * count * rows * cols * storage.itemsize
+    if footprint > settings.JOB_MEMORY_BUDGET:
+        raise ValueError(f"batch needs {footprint} bytes, more than the {settings.JOB_MEMORY_BUDGET} a job may use")
+    results = is_true(params.get("results", False))
+    if results and count * rows * cols > settings.MAX_JSON_RESULT_ELEMENTS:
+        raise ValueError(f"results would exceed {settings.MAX_JSON_RESULT_ELEMENTS} elements; request checksums only")
+    return { **batch, "dtype": dtype, "results": results }
+
+def job_response(job):
+    # Encode once to time serialization, then again with that time included
+    body = { "job_id": job.id, **job.result }
+    body["timings"] = { **job.result["timings"], "queue_seconds": job.started_at - job.submitted_at }
+    start = time.perf_counter()
+    json.dumps(body)
+    serialize_seconds = time.perf_counter() - start
+    stage_seconds.observe(serialize_seconds, stage="serialize", size_bucket=size_bucket(job_size(job)))
+    body["timings"]["serialize_seconds"] = serialize_seconds
+    body["timings"]["total_seconds"] = time.time() - job.submitted_at
+    return Response(json.dumps(body), mimetype="application/json")
+
+@app.errorhandler(ValueError)
+def bad_parameter(e):
+    return jsonify({ "error": f"invalid parameter: {e}" }), 400
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify({ "error": "service busy", "reason": str(e), "predicted_seconds": e.predicted_seconds,
+                     "limit_seconds": e.limit_seconds }), 503
+
+@app.errorhandler(uploads.SpoolFull)
+def spool_full(e):
+    return jsonify({ "error": "service busy", "reason": str(e) }), 503
+
+@app.errorhandler(PoolFull)
+def service_busy(e):
+    return jsonify({ "error": "service busy" }), 503
+
+@app.errorhandler(JobCancelled)
+def job_cancelled(e):
+    return jsonify({ "error": e.reason, "discarded": e.discarded }), 504 if e.reason == "deadline exceeded" else 409
+
+@app.errorhandler(JobFailed)
+def job_failed(e):
+    return jsonify({ "error": str(e) }), 500
+
+def coalesce_key(kind, params, priority):
+    # Only explicitly seeded requests are reproducible, so only those can
+    # share a computation; unseeded ones ask for fresh random operands.
+    if params.get("seed") is None:
+        return None
+    return (kind, priority, json.dumps(params, sort_keys=True))
+
+def wait_for(kind, params, priority, deadline=None):
+    # A deadline is not shared, so requests with one are never coalesced
+    key = coalesce_key(kind, params, priority) if deadline is None else None
+    job = jobs.submit(kind, params, max_queue=pool.queue_size, priority=priority, key=key, deadline=deadline)
+    try:
+        job.future.result(timeout=None if deadline is None else max(0, deadline - time.time()))
+    except futures.TimeoutError:
+        # Answer at the deadline. Queued jobs are dropped at once; running
+        # ones stop at their next tile or block boundary, and a GEMM already
+        # under way finishes in the background.
+        jobs.cancel(job.id, "deadline exceeded")
+        if not job.future.done():
+            raise JobCancelled("deadline exceeded", job.discarded_now())
+        job.future.result()
+    return job
+
+def run_sync(kind, parse):
+    params = request_params()
+    return job_response(wait_for(kind, parse(params), priority_param(params), deadline_param(params)))
 
 @app.route("/multiply")
 def multiply(): 
-    global busy
-    if busy: return jsonify({ "error": "service busy" })
-    busy = True
-
-    size = request.args.get("size", default=2000, type=int)
-    a = np.random.rand(size, size)
-    b = np.random.rand(size, size)
-    
-    start = time.time()
-    np.dot(a, b)
-    end = time.time()
-    total_time = end - start
-
-    busy = False
-    return jsonify({ "size": f"{size},{size}" })
+    return run_sync("multiply", multiply_params)
 
-@app.route("/status")
-def status():
-    return jsonify({ "busy": busy })
+def chain_params(params):
+    dims = params.get("dims")
+    if isinstance(dims, str):
+        dims = dims.split(",")
+    try:
+        dims = [int(d) for d in dims]
+    except (TypeError, ValueError):
+        raise ValueError("dims must be a list of integers, e.g. 10,30,5,60")
+    if len(dims) < 3 or min(dims) < 1:
+        raise ValueError("dims needs at least three positive entries (two matrices)")
+    dtype = dtype_param(params)
+    itemsize = np.dtype(DTYPES[dtype][1]).itemsize
+    # Inputs plus, at worst, the two largest possible intermediates
+    operand_bytes = sum(dims[i] * dims[i + 1] for i in range(len(dims) - 1)) * itemsize
+    largest = max(dims) ** 2 * itemsize
+    if operand_bytes + 2 * largest > settings.JOB_MEMORY_BUDGET:
+        raise ValueError(f"chain does not fit the {settings.JOB_MEMORY_BUDGET} bytes a job may use")
+    return { "dims": dims, "seed": seed_param(params), "dtype": dtype }
+
+@app.route("/multiply/chain", methods=["GET", "POST"])
+def multiply_chain():
+    return run_sync("chain", chain_params)
+
+def power_params(params):
+    size = int(params.get("size", 1000))
+    exp = int(params.get("exp", 2))
+    if size < 1 or exp < 0:
+        raise ValueError("size must be positive and exp non-negative")
+    dtype = dtype_param(params)
+    # A and the two ping-pong buffers, all held at the accumulation dtype
+    footprint = 3 * size * size * np.dtype(DTYPES[dtype][1]).itemsize
+    if footprint > settings.JOB_MEMORY_BUDGET:
+        raise ValueError(f"power needs {footprint} bytes, more than the {settings.JOB_MEMORY_BUDGET} a job may use")
+    return { "size": size, "exp": exp, "seed": seed_param(params), "dtype": dtype }
+
+@app.route("/power", methods=["GET", "POST"])
+def matrix_power():
+    return run_sync("power", power_params)
+
+@app.route("/estimate")
+def estimate():
+    # What a /multiply with the same parameters is predicted to cost, and
+    # when it would finish behind the work already queued
+    params = request_params()
+    priority = priority_param(params)
+    parsed = multiply_params(params)
+    if parsed["density"] is not None:
+        raise ValueError("estimates cover dense products only")
+    if not cost.ready:
+        return jsonify({ "error": "calibration pending" }), 503
+    prediction = cost.estimate("multiply", parsed)
+    backlog = jobs.backlog(priority)
+    return jsonify({ **prediction, "priority": priority, "queue_seconds": backlog,
+                     "finish_seconds": backlog + prediction["seconds"] })
+
+@app.route("/multiply/batch", methods=["GET", "POST"])
+def multiply_batch():
+    return run_sync("batch", batch_params)
+
+def raw_headers():
+    dtype = request.headers.get("X-Dtype", "float64")
+    if dtype not in DTYPES:
+        raise ValueError(f"X-Dtype must be one of {', '.join(DTYPES)}")
+    shape_a = uploads.parse_shape(request.headers.get("X-Shape-A"), "X-Shape-A")
+    shape_b = uploads.parse_shape(request.headers.get("X-Shape-B"), "X-Shape-B")
+    return dtype, shape_a, shape_b
+
+def upload_refusal(npy):
+    # Checked before any of the body is spooled to memory-backed storage.
+    # Raw bodies must have exactly the length their headers describe.
+    length = request.content_length
+    if length is None:
+        return jsonify({ "error": "Content-Length required" }), 411
+    if not npy:
+        dtype, shape_a, shape_b = raw_headers()
+        expected = (int(np.prod(shape_a)) + int(np.prod(shape_b))) * np.dtype(DTYPES[dtype][0]).itemsize
+        if length != expected:
+            raise ValueError(f"body has {length} bytes, X-Dtype, X-Shape-A and X-Shape-B describe {expected}")
+    limit = min(settings.MAX_UPLOAD_BYTES, settings.MAX_SPOOL_BYTES)
+    if length > limit:
+        return jsonify({ "error": f"body of {length} bytes exceeds the {limit} byte limit" }), 413
+    return None
+
+def upload_params(path, npy):
+    if npy:
+        a, b = uploads.npy_layouts(path)
+    else:
+        a, b = uploads.raw_layouts(path, *raw_headers())
+    if len(a["shape"]) != 2 or len(b["shape"]) != 2 or a["shape"][1] != b["shape"][0]:
+        raise ValueError(f"cannot multiply shapes {a['shape']} and {b['shape']}")
+    if a["dtype"] != b["dtype"]:
+        raise ValueError("operands must have the same dtype")
+    dtype = np.dtype(a["dtype"])
+    if dtype.name not in DTYPES or dtype.str[0] == ">":
+        raise ValueError(f"operands must be little-endian {', '.join(DTYPES)}")
+    out_bytes = a["shape"][0] * b["shape"][1] * dtype.itemsize
+    if out_bytes > settings.JOB_MEMORY_BUDGET:
+        raise ValueError(f"product needs {out_bytes} bytes, more than the {settings.JOB_MEMORY_BUDGET} a job may use")
+    if os.path.getsize(path) + out_bytes > settings.MAX_SPOOL_BYTES:
+        raise ValueError(f"body and product need {os.path.getsize(path) + out_bytes} bytes, "
+                         f"more than the {settings.MAX_SPOOL_BYTES} that may be spooled")
+    return { "path": path, "a": a, "b": b }
+
+@app.route("/multiply/upload", methods=["POST"])
+def multiply_upload():
+    # Body: two .npy payloads (Content-Type: application/x-npy), or raw
+    # little-endian buffers described by X-Dtype, X-Shape-A and X-Shape-B.
+    # The product comes back in the same format.
+    npy = request.mimetype == "application/x-npy"
+    refusal = upload_refusal(npy)
+    if refusal is not None:
+        return refusal
+    # The body, then the product, are reserved against the spool budget
+    # until the response is closed and the result file's handle with it
+    reserved = request.content_length
+    spool.reserve(reserved)
+    try:
+        upload = uploads.spool_path(settings.SPOOL_DIR, ".in")
+        result = uploads.spool_path(settings.SPOOL_DIR, ".npy" if npy else ".bin")
+        try:
+            uploads.save_stream(request.stream, upload)
+            params = { **upload_params(upload, npy), "out_path": result, "out_format": "npy" if npy else "raw",
+                       "verify": verify_param(request.args) }
+            product = { **params["a"], "shape": (params["a"]["shape"][0], params["b"]["shape"][1]) }
+            spool.reserve(uploads.nbytes(product))
+            reserved += uploads.nbytes(product)
+            job = wait_for("upload", params, priority_param(request.args), deadline_param(request.args))
+        except BaseException:
+            os.remove(result)
+            raise
+        finally:
+            os.remove(upload)
+    except BaseException:
+        spool.release(reserved)
+        raise
+
+    # Unlink now; the open handle keeps the data until the response is sent
+    body = open(result, "rb")
+    os.remove(result)
+    response = send_file(body, mimetype="application/x-npy" if npy else "application/octet-stream")
+    # Passed straight through, the file would skip the response's close hooks
+    response.direct_passthrough = False
+    response.call_on_close(lambda: spool.release(reserved))
+    response.content_length = os.fstat(body.fileno()).st_size
+    rows, _, cols = job.result["shape"].split(",")
+    timings = { **job.result["timings"], "queue_seconds": job.started_at - job.submitted_at }
+    response.headers["X-Job-Id"] = job.id
+    response.headers["X-Shape"] = f"{rows},{cols}"
+    response.headers["X-Dtype"] = job.result["precision"]["dtype"]
+    response.headers["X-Checksum"] = repr(job.result["checksum"])
+    if "verification" in job.result:
+        response.headers["X-Verification"] = "passed" if job.result["verification"]["passed"] else "failed"
+    response.headers["X-Gflops"] = repr(job.result["gflops"])
+    response.headers["Server-Timing"] = ", ".join(
+        f"{key.removesuffix('_seconds')};dur={seconds * 1000:.3f}" for key, seconds in timings.items()
+    )
+    return response
+
+def stream_rows(job, path, header, row_bytes, rows, chunk=1 << 20):
+    # Yield the product as the worker reports row blocks done; only one
+    # read chunk is held in memory at a time.
+    sent = 0
+    try:
+        yield header
+        # Unbuffered: read-ahead would cache rows the worker has not written yet
+        with open(path, "rb", buffering=0) as f:
+            while sent < rows * row_bytes:
+                with job.updated:
+                    job.updated.wait_for(lambda: job.finished or job.detail.get("done", 0) * row_bytes > sent)
+                if job.finished and job.state != "done":
+                    # Abort the connection instead of ending the chunked
+                    # body cleanly, so the client sees the download failed
+                    raise JobFailed(f"stream job {job.state}: {job.error}")
+                available = (rows if job.state == "done" else job.detail["done"]) * row_bytes
+                while sent < available:
+                    data = f.read(min(chunk, available - sent))
+                    sent += len(data)
+                    yield data
+    finally:
+        # Also reached when the client disconnects: stop computing rows for nobody
+        jobs.cancel(job.id)
+        os.remove(path)
+
+@app.route("/multiply/stream")
+def multiply_stream():
+    # The product of a seeded (m×k)·(k×n) multiplication, streamed in row
+    # blocks as .npy (default) or raw little-endian data with format=raw.
+    params = request_params()
+    npy = params.get("format", "npy") == "npy"
+    stream = { key: value for key, value in multiply_params(params).items() if key in ("m", "k", "n", "seed", "dtype") }
+    rows, cols = stream["m"], stream["n"]
+    dtype = np.dtype(DTYPES[stream["dtype"]][0]).newbyteorder("<")
+    row_bytes = cols * dtype.itemsize
+    stream["block_rows"] = max(1, settings.STREAM_BLOCK_MB * 2**20 // row_bytes)
+
+    path = uploads.spool_path(settings.SCRATCH_DIR, ".bin")
+    try:
+        job = jobs.submit("stream", { **stream, "out_path": path }, max_queue=pool.queue_size,
+                          priority=priority_param(params), deadline=deadline_param(params))
+    except BaseException:
+        os.remove(path)
+        raise
+
+    header = io.BytesIO()
+    if npy:
+        np.lib.format.write_array_header_1_0(header, { "descr": dtype.str, "fortran_order": False, "shape": (rows, cols) })
+    response = Response(
+        stream_rows(job, path, header.getvalue(), row_bytes, rows),
+        mimetype="application/x-npy" if npy else "application/octet-stream",
+    )
+    response.headers["X-Job-Id"] = job.id
+    response.headers["X-Shape"] = f"{rows},{cols}"
+    response.headers["X-Dtype"] = stream["dtype"]
+    return response
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    try:
+        params = request_params()
+        priority = priority_param(params)
+        deadline = deadline_param(params)
+        params = multiply_params(params)
+        key = coalesce_key("multiply", params, priority) if deadline is None else None
+        job = jobs.submit("multiply", params, priority=priority, key=key, deadline=deadline)
+    except Overloaded as e:
+        return overloaded(e)
+    except PoolFull:
+        return jsonify({ "error": "job queue full" }), 503
+
+    response = jsonify({
+        **job.to_dict(),
+        "status_url": url_for("job_status", job_id=job.id),
+        "result_url": url_for("job_result", job_id=job.id),
+        "events_url": url_for("job_event_stream", job_id=job.id),
+    })
+    response.headers["Location"] = url_for("job_status", job_id=job.id)
+    return response, 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({ "error": "unknown job" }), 404
+    return jsonify(job.to_dict())
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def job_events(job, keepalive=15):
+    # One event per state change or progress report, with the completion
+    # estimate and the GFLOP/s achieved since the previous report this
+    # stream saw, then a final done, failed or cancelled event.
+    seen = -1
+    last = None
+    while True:
+        with job.updated:
+            if not job.updated.wait_for(lambda: job.version != seen, timeout=keepalive):
+                yield ": keep-alive\n\n"
+                continue
+            seen = job.version
+        if job.finished:
+            break
+        info = { "job_id": job.id, "state": job.state, "priority": job.priority, "preemptions": job.preemptions }
+        estimate = job.estimate()
+        if estimate is not None:
+            # Rated between the times the reports arrived, not when this
+            # stream got to them
+            reported_at = estimate.pop("reported_at")
+            if estimate["flops"] is not None:
+                if last is not None and reported_at > last[0]:
+                    estimate["gflops"] = (estimate["flops"] - last[1]) / (reported_at - last[0]) / 1e9
+                last = (reported_at, estimate["flops"])
+            info.update(estimate)
+        yield sse("progress", info)
+
+    if job.state == "done":
+        yield sse("done", { "job_id": job.id, **job.result })
+    else:
+        yield sse(job.state, { **job.to_dict(), "error": job.error })
+
+@app.route("/jobs/<job_id>/events")
+def job_event_stream(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({ "error": "unknown job" }), 404
+    response = Response(job_events(job), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    # Queued jobs are dropped at once; running ones stop at their next tile
+    # or block boundary and then report the work they discarded. A job other
+    # requests were coalesced onto keeps running until all have cancelled.
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({ "error": "unknown job" }), 404
+    if job.finished:
+        return jsonify({ "error": "job already finished", "job_id": job.id, "state": job.state }), 409
+    jobs.cancel(job_id)
+    return jsonify(job.to_dict()), 202
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({ "error": "unknown job" }), 404
+    if job.state == "failed":
+        return jsonify({ "error": job.error, "job_id": job.id }), 500
+    if job.state == "cancelled":
+        return jsonify({ "error": job.error, "job_id": job.id, "discarded": job.discarded }), 410
+    if job.state != "done":
+        return jsonify({ "error": "job not finished", "job_id": job.id, "state": job.state }), 409
+    if verify_param(request.args) and "verification" not in job.result:
+        # Only the summary outlives the worker, so there is nothing left to check
+        return jsonify({ "error": "verify must be requested when the job is submitted", "job_id": job.id }), 409
+    return job_response(job)
+
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/")
 def default():
@@ -34,11 +589,26 @@ def default():
 
 @app.route("/status")
 def status():
+    stats = pool.stats()
+    busy = stats["free_slots"] == 0
     return jsonify({ 
-        "status": "ready",
-        "busy": False,
-        "message": "Service is available"
+        "status": "busy" if busy else "ready",
+        "busy": busy,
+        "message": "All workers are busy" if busy else "Service is available",
+        "cpu_limit": settings.CPU_LIMIT,
+        "cpu_quota": settings.CPU_QUOTA,
+        **stats,
+        **jobs.stats(),
+        "operand_cache": { result: operand_cache.value(result=result) for result in ("hits", "misses") },
+        "coalesced": sum(coalesced.value(kind=kind) for kind in TASKS),
+        "output_arena_bytes": { result: output_arena.value(result=result) for result in ("reused", "allocated", "evicted") },
+        "strassen_tuning": tuning.to_dict(),
+        "cost_model": cost.to_dict(),
     })
 
 if __name__ == "__main__":
-    app.run(host = "0.0.0.0", port = 3000)
+    pool.start()
+    tuning.start(pool)
+    # HTTP/1.1 so streamed responses go out with chunked transfer encoding
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(host = "0.0.0.0", port = 3000, threaded = True)
@@ -0,0 +1,159 @@
+import bisect
+import collections
+import math
+import threading
+
+# Upper bounds of the size buckets the per-request metrics are grouped by.
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def size_bucket(size):
+    index = bisect.bisect_left(SIZE_BUCKETS, size)
+    return str(SIZE_BUCKETS[index]) if index < len(SIZE_BUCKETS) else "+Inf"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                lines.extend(self._render_series(labels, series))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(tuple(sorted(labels.items())), 0)
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, { "counts": [0] * len(self.buckets), "sum": 0.0 })
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+
+    def _render_series(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series["counts"]):
+            cumulative += count
+            bucket_labels = labels + (("le", format_value(bound)),)
+            lines.append(f"{self.name}_bucket{format_labels(bucket_labels)} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Summary(Metric):
+    kind = "summary"
+
+    def __init__(self, name, help, window=256):
+        super().__init__(name, help)
+        self.window = window
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {
+                "recent": collections.deque(maxlen=self.window),
+                "sum": 0.0,
+                "count": 0,
+            })
+            series["recent"].append(value)
+            series["sum"] += value
+            series["count"] += 1
+
+    def _render_series(self, labels, series):
+        # Quantiles cover the most recent observations only; sum and count
+        # are cumulative, as Prometheus expects.
+        recent = sorted(series["recent"])
+        lines = []
+        for q in QUANTILES:
+            value = recent[min(len(recent) - 1, int(q * len(recent)))]
+            lines.append(f"{self.name}{format_labels(labels + (('quantile', str(q)),))} {format_value(value)}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name, help, **kwargs):
+        return self._add(Histogram(name, help, **kwargs))
+
+    def summary(self, name, help, **kwargs):
+        return self._add(Summary(name, help, **kwargs))
+
+    def on_collect(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
@@ -0,0 +1,147 @@
+import collections
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+import settings
+
+BIT_GENERATORS = {
+    "pcg64": np.random.PCG64,
+    "philox": np.random.Philox,
+}
+
+# Rows are filled in chunks of about this many elements, each from its own
+# spawned stream. The split depends only on the shape, never on the thread
+# count, so a seed gives the same matrix on every pod.
+CHUNK_ELEMENTS = 1 << 20
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(settings.GENERATOR_THREADS, thread_name_prefix="generate")
+    return _executor
+
+
+def new_seed():
+    # 53 bits so the seed survives a round trip through a JavaScript number
+    return secrets.randbits(53)
+
+
+def operand_seeds(seed, count=2):
+    return np.random.SeedSequence(seed).spawn(count)
+
+
+def chunk_plan(shape, seed_seq):
+    row_elements = max(1, int(np.prod(shape[1:])))
+    chunk_rows = max(1, CHUNK_ELEMENTS // row_elements)
+    starts = range(0, shape[0], chunk_rows)
+    return chunk_rows, list(zip(starts, seed_seq.spawn(len(starts))))
+
+
+def fill_chunks(out, chunks, chunk_rows, first_row=0):
+    # `out` holds rows first_row onwards of the full matrix
+    bit_generator = BIT_GENERATORS[settings.BIT_GENERATOR]
+
+    def fill(start, child):
+        rng = np.random.Generator(bit_generator(child))
+        chunk = out[start - first_row:start - first_row + chunk_rows]
+        if out.dtype in (np.float32, np.float64):
+            rng.random(out=chunk, dtype=out.dtype)
+        else:
+            # Generator only produces float32/float64; narrow afterwards
+            chunk[...] = rng.random(chunk.shape, dtype=np.float32)
+
+    list(executor().map(lambda chunk: fill(*chunk), chunks))
+
+
+def random_matrix(shape, seed_seq, dtype=np.float64, out=None):
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    chunk_rows, chunks = chunk_plan(out.shape, seed_seq)
+    fill_chunks(out, chunks, chunk_rows)
+    return out
+
+
+def random_row_blocks(shape, seed_seq, dtype, block_rows):
+    # The same matrix random_matrix builds, produced as (first_row, block)
+    # pairs of about block_rows rows in one reused buffer.
+    chunk_rows, chunks = chunk_plan(shape, seed_seq)
+    per_block = max(1, block_rows // chunk_rows)
+    buffer = np.empty((min(shape[0], per_block * chunk_rows),) + tuple(shape[1:]), dtype=dtype)
+    for i in range(0, len(chunks), per_block):
+        first_row = chunks[i][0]
+        block = buffer[:min(shape[0] - first_row, len(buffer))]
+        fill_chunks(block, chunks[i:i + per_block], chunk_rows, first_row)
+        yield first_row, block
+
+
+# LRU of generated operands, bounded by their total size in bytes.
+class OperandCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # The running job and the prefetcher look up operands concurrently
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        # Returns (matrix, hit); create() runs outside the lock
+        with self._lock:
+            matrix = self._entries.get(key)
+            if matrix is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return matrix, True
+            self.misses += 1
+        matrix = create()
+        if matrix.nbytes <= self.max_bytes:
+            # Shared between requests, so nobody may write into it
+            matrix.setflags(write=False)
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = matrix
+                    self.bytes += matrix.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+        return matrix, False
+
+
+cache = OperandCache(settings.OPERAND_CACHE_BYTES)
+
+
+def seeded_operands(shape_a, shape_b, seed, dtype=np.float64, cached=True):
+    # Only explicitly seeded requests are worth caching; a fresh random seed
+    # would never be asked for again.
+    seed_a, seed_b = operand_seeds(seed)
+    dtype = np.dtype(dtype)
+    if not cached:
+        a = random_matrix(shape_a, seed_a, dtype)
+        b = random_matrix(shape_b, seed_b, dtype)
+        return a, b, { "hits": 0, "misses": 0 }
+    a, hit_a = cache.get((shape_a, seed, dtype.str, "a"), lambda: random_matrix(shape_a, seed_a, dtype))
+    b, hit_b = cache.get((shape_b, seed, dtype.str, "b"), lambda: random_matrix(shape_b, seed_b, dtype))
+    return a, b, { "hits": hit_a + hit_b, "misses": 2 - hit_a - hit_b }
+
+
+def sparse_operands(shape_a, shape_b, seed, density, dtype=np.float64):
+    # Uniform random nonzeros at the given density; A in CSR and B in CSC,
+    # the layouts a sparse A @ B walks row- and column-wise.
+    seed_a, seed_b = operand_seeds(seed)
+    a = scipy.sparse.random(*shape_a, density=density, format="csr", dtype=dtype,
+                            random_state=np.random.Generator(np.random.PCG64(seed_a)))
+    b = scipy.sparse.random(*shape_b, density=density, format="csc", dtype=dtype,
+                            random_state=np.random.Generator(np.random.PCG64(seed_b)))
+    return a, b
+
+
+def sparse_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
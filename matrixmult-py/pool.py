@@ -0,0 +1,479 @@
+import collections
+import contextlib
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+from threadpoolctl import threadpool_limits
+
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+# Queue classes, most urgent first
+PRIORITIES = ("critical", "normal", "batch")
+
+
+class PoolFull(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    pass
+
+
+class JobCancelled(JobFailed):
+    # `discarded` describes the work thrown away, as reported by the worker
+    def __init__(self, reason, discarded):
+        super().__init__(reason)
+        self.reason = reason
+        self.discarded = discarded
+
+
+@contextlib.contextmanager
+def blas_env(threads):
+    # Spawned workers inherit the parent's environment, and BLAS sizes its
+    # thread pool from these when numpy is first imported, so set them only
+    # around start(). Per-job budgets can lower the count but never raise it.
+    saved = { var: os.environ.get(var) for var in BLAS_ENV_VARS }
+    os.environ.update({ var: str(threads) for var in BLAS_ENV_VARS })
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def worker_main(conn, progress_interval=0.0):
+    import control
+    import engine
+
+    # Tasks may arrive while another one runs. The receiver thread hands
+    # those to the engine's prefetcher, so their operands are built while
+    # the current job computes, and queues every task for the loop below.
+    # It also passes on requests to preempt or cancel the running job;
+    # cancelled tasks that have not started yet are skipped when they come up,
+    # and reported as cancelled so the pool never waits on them.
+    inbox = queue.Queue()
+    running = threading.Event()
+
+    def receive():
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                message = None
+            if message is None:
+                inbox.put(None)
+                return
+            if message[0] == "preempt":
+                control.job.preempt(message[1])
+                continue
+            if message[0] == "cancel":
+                control.job.cancel(message[1])
+                continue
+            _, job_id, kind, params, threads, deadline = message
+            control.job.expect(job_id)
+            prefetched = engine.prefetch(kind, params) if running.is_set() else None
+            inbox.put((job_id, kind, params, threads, deadline, prefetched))
+
+    threading.Thread(target=receive, name="worker-receiver", daemon=True).start()
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        job_id, kind, params, threads, deadline, prefetched = message
+        if not control.job.start(job_id, deadline):
+            # The pool ignores this if it already dropped the task
+            discarded = checkpoint_discarded(params.get("checkpoint"))
+            conn.send(("cancelled", job_id, { "reason": "cancelled", "discarded": discarded }))
+            continue
+        running.set()
+        conn.send(("started", job_id, None))
+        # Time spent on the job in earlier runs, before it was preempted
+        started = time.time() - params.get("checkpoint", {}).get("seconds", 0.0)
+
+        last_report = [0.0]
+
+        def report(**data):
+            # At a fixed cadence, whatever the engine's tile or block rate;
+            # the first report and the final one always go out
+            now = time.monotonic()
+            if now - last_report[0] < progress_interval and data.get("done") != data.get("total"):
+                return
+            last_report[0] = now
+            conn.send(("progress", job_id, data))
+
+        try:
+            control.job.check()
+            with threadpool_limits(limits=threads, user_api="blas"):
+                result = engine.run(kind, params, report, prefetched)
+            conn.send(("done", job_id, { **result, "blas_threads": threads }))
+        except control.Preempted as e:
+            conn.send(("preempted", job_id, { **e.checkpoint, "seconds": time.time() - started }))
+        except control.Cancelled as e:
+            discarded = { **e.discarded, "seconds": time.time() - started }
+            conn.send(("cancelled", job_id, { "reason": e.reason, "discarded": discarded }))
+        except Exception as e:
+            conn.send(("error", job_id, f"{type(e).__name__}: {e}"))
+        if inbox.empty():
+            running.clear()
+
+
+def checkpoint_discarded(checkpoint):
+    # Work thrown away by dropping a task before it runs again: none,
+    # unless an earlier run was preempted
+    checkpoint = checkpoint or {}
+    done, total = checkpoint.get("cursor", 0), checkpoint.get("total", 1)
+    return {
+        "done": done,
+        "total": total,
+        "completed_fraction": done / total,
+        "discarded_flops": checkpoint.get("flops", 0) * done // total,
+        "seconds": checkpoint.get("seconds", 0.0),
+    }
+
+
+class Task:
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, params, threads, listener=None, priority="normal", deadline=None):
+        self.id = next(Task._ids)
+        self.kind = kind
+        self.params = params
+        self.threads = threads
+        self.listener = listener
+        self.priority = priority
+        self.level = PRIORITIES.index(priority)
+        self.queued_at = time.monotonic()
+        # Wall-clock time after which the worker abandons the task
+        self.deadline = deadline
+        # Set from the worker's progress reports by engines that can stop
+        # at a checkpoint and resume later
+        self.preemptible = False
+        # Reason the running task was asked to stop, if it was
+        self.cancelled = None
+        self.future = Future()
+
+    def discarded(self):
+        return checkpoint_discarded(self.params.get("checkpoint"))
+
+    def discard_checkpoint(self):
+        # A preempted task that will never resume owns its scratch directory
+        checkpoint = self.params.get("checkpoint")
+        if checkpoint is not None:
+            shutil.rmtree(checkpoint["scratch"], ignore_errors=True)
+
+    def notify(self, event, data=None):
+        if self.listener is not None:
+            self.listener(event, data)
+
+
+# One FIFO per priority class. The next task is the one with the most urgent
+# class after aging: every `aging` seconds of waiting lifts a task by one
+# class, so a steady stream of critical work cannot starve batch jobs.
+class PendingQueue:
+    def __init__(self, aging):
+        self.aging = aging
+        self._classes = [collections.deque() for _ in PRIORITIES]
+
+    def __len__(self):
+        return sum(len(tasks) for tasks in self._classes)
+
+    def append(self, task):
+        # Arrival order within a class; preempted tasks rejoin at their old place
+        tasks = self._classes[task.level]
+        index = len(tasks)
+        while index and tasks[index - 1].queued_at > task.queued_at:
+            index -= 1
+        tasks.insert(index, task)
+
+    def peek(self):
+        heads = [tasks[0] for tasks in self._classes if tasks]
+        return min(heads, key=self.urgency, default=None)
+
+    def popleft(self):
+        task = self.peek()
+        self._classes[task.level].popleft()
+        return task
+
+    def remove(self, future):
+        for tasks in self._classes:
+            for task in tasks:
+                if task.future is future:
+                    tasks.remove(task)
+                    return task
+        return None
+
+    def ahead_of(self, level):
+        # Tasks that would be served before a new one of this class
+        return sum(len(tasks) for tasks in self._classes[:level + 1])
+
+    def depths(self):
+        return { priority: len(tasks) for priority, tasks in zip(PRIORITIES, self._classes) }
+
+    def urgency(self, task):
+        # Lower is served first
+        if self.aging <= 0:
+            return task.level, task.queued_at
+        return task.level - (time.monotonic() - task.queued_at) / self.aging, task.queued_at
+
+
+class Worker:
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        # Tasks sent to the worker, in order; the first one is running
+        self.tasks = collections.deque()
+        self.preempting = False
+
+    @property
+    def task(self):
+        return self.tasks[0] if self.tasks else None
+
+
+class WorkerPool:
+    def __init__(self, workers, blas_threads, queue_size, max_threads=None, prefetch_depth=0, prefetch_kinds=(),
+                 aging=0, progress_interval=0.0):
+        self.size = workers
+        self.blas_threads = blas_threads
+        self.max_threads = max(blas_threads, max_threads or blas_threads)
+        self.queue_size = queue_size
+        # Up to prefetch_depth tasks of these kinds may be sent to a busy
+        # worker so it can prepare them while its current task runs.
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_kinds = prefetch_kinds
+        self.progress_interval = progress_interval
+        self._ctx = mp.get_context("spawn")
+        self._lock = threading.Lock()
+        self._pending = PendingQueue(aging)
+        self._workers = []
+
+    def start(self):
+        self._workers = [self._spawn(i) for i in range(self.size)]
+        threading.Thread(target=self._collect, name="pool-collector", daemon=True).start()
+
+    def _spawn(self, index):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(child_conn, self.progress_interval),
+            name=f"matrix-worker-{index}",
+            daemon=True,
+        )
+        with blas_env(self.max_threads):
+            process.start()
+        child_conn.close()
+        return Worker(index, process, parent_conn)
+
+    def submit(self, kind, params, listener=None, max_queue=None, threads=None, priority="normal", deadline=None):
+        # listener(event, data) is called from the pool's threads with
+        # "started" and "progress" events; the returned Future carries the result.
+        # A task is refused only when max_queue tasks of its class or a more
+        # urgent one are already waiting.
+        if max_queue is None:
+            max_queue = self.queue_size
+        threads = min(self.max_threads, threads or self.blas_threads)
+        task = Task(kind, params, threads, listener, priority, deadline)
+        with self._lock:
+            if self._in_use() == self.size and self._pending.ahead_of(task.level) >= max_queue:
+                raise PoolFull()
+            self._pending.append(task)
+            self._dispatch()
+        return task.future
+
+    def cancel(self, future, reason="cancelled"):
+        # Queued tasks, and those a worker holds but has not started, are
+        # dropped at once; a running one is stopped by its worker at the next
+        # tile or block boundary and reports what it discarded.
+        with self._lock:
+            task = self._pending.remove(future)
+            for worker in self._workers:
+                if task is not None:
+                    break
+                for sent in worker.tasks:
+                    if sent.future is future:
+                        worker.conn.send(("cancel", sent.id))
+                        if sent is worker.task:
+                            sent.cancelled = reason
+                            return True
+                        worker.tasks.remove(sent)
+                        task = sent
+                        break
+            if task is None:
+                return False
+        task.discard_checkpoint()
+        task.future.set_exception(JobCancelled(reason, task.discarded()))
+        return True
+
+    def stats(self):
+        with self._lock:
+            in_use = self._in_use()
+            return {
+                "workers": self.size,
+                "blas_threads_per_worker": self.blas_threads,
+                "max_blas_threads": self.max_threads,
+                "blas_threads_in_use": sum(w.task.threads for w in self._workers if w.task is not None),
+                "slots_in_use": in_use,
+                "free_slots": self.size - in_use,
+                "queue_depth": len(self._pending),
+                "queue_depth_by_priority": self._pending.depths(),
+                "prefetched": sum(max(0, len(w.tasks) - 1) for w in self._workers),
+                "queue_capacity": self.queue_size,
+            }
+
+    def _in_use(self):
+        return sum(1 for worker in self._workers if worker.task is not None)
+
+    def _dispatch(self):
+        # Caller holds self._lock. Idle workers first; only once none is left
+        # do busy workers take prefetchable tasks, least loaded first, and
+        # workers about to be preempted before the rest.
+        for worker in self._workers:
+            if not self._pending:
+                return
+            if worker.task is None:
+                self._send(worker, self._pending.popleft())
+        self._recall()
+        self._preempt()
+        workers = sorted(self._workers, key=lambda worker: not worker.preempting)
+        for depth in range(1, self.prefetch_depth + 1):
+            for worker in workers:
+                if not self._pending or self._pending.peek().kind not in self.prefetch_kinds:
+                    return
+                if len(worker.tasks) == depth:
+                    self._send(worker, self._pending.popleft())
+
+    def _recall(self):
+        # Caller holds self._lock. Prefetched tasks a waiting one outranks go
+        # back to the queue, so they do not hold up more urgent work behind
+        # them in the worker's inbox; the worker skips them when they come up.
+        head = self._pending.peek()
+        if head is None:
+            return
+        for worker in self._workers:
+            for sent in list(worker.tasks)[1:]:
+                if self._pending.urgency(sent) > self._pending.urgency(head):
+                    worker.conn.send(("cancel", sent.id))
+                    worker.tasks.remove(sent)
+                    # A new id, so nothing the worker still sends about the
+                    # old one can be taken for this task's
+                    sent.id = next(Task._ids)
+                    self._pending.append(sent)
+
+    def _preempt(self):
+        # Caller holds self._lock. Ask running, preemptible, non-critical
+        # tasks to checkpoint: first those with a critical task prefetched
+        # behind them, then one for each critical task left waiting.
+        def preempt(worker):
+            task = worker.task
+            if task is None or not task.preemptible or task.level == 0 or worker.preempting:
+                return False
+            worker.preempting = True
+            worker.conn.send(("preempt", task.id))
+            return True
+
+        for worker in self._workers:
+            if any(sent.level == 0 for sent in list(worker.tasks)[1:]):
+                preempt(worker)
+        waiting = self._pending.depths()[PRIORITIES[0]]
+        waiting -= sum(1 for worker in self._workers if worker.preempting
+                       and not any(sent.level == 0 for sent in list(worker.tasks)[1:]))
+        for worker in sorted(self._workers, key=lambda worker: len(worker.tasks)):
+            if waiting <= 0:
+                return
+            if preempt(worker):
+                waiting -= 1
+
+    def _send(self, worker, task):
+        worker.tasks.append(task)
+        worker.conn.send(("run", task.id, task.kind, task.params, task.threads, task.deadline))
+
+    def _collect(self):
+        while True:
+            with self._lock:
+                workers = list(self._workers)
+            by_conn = { worker.conn: worker for worker in workers }
+            by_sentinel = { worker.process.sentinel: worker for worker in workers }
+
+            ready = wait(list(by_conn) + list(by_sentinel))
+            for obj in ready:
+                if obj in by_conn:
+                    worker = by_conn[obj]
+                    try:
+                        event, job_id, payload = worker.conn.recv()
+                    except (EOFError, OSError):
+                        continue
+                    if worker.task is None or worker.task.id != job_id:
+                        # A task the pool dropped while the worker held it
+                        continue
+                    if event in ("started", "progress"):
+                        self._progress(worker, event, payload)
+                    elif event == "preempted":
+                        self._requeue(worker, payload)
+                    else:
+                        self._finish(worker, event, payload)
+            for obj in ready:
+                if obj in by_sentinel:
+                    self._replace(by_sentinel[obj])
+
+    def _progress(self, worker, event, payload):
+        task = worker.task
+        if event == "progress" and payload.get("preemptible") and not task.preemptible:
+            with self._lock:
+                task.preemptible = True
+                self._preempt()
+        task.notify(event, payload)
+
+    def _requeue(self, worker, checkpoint):
+        # The task goes back into its queue with its original place in line,
+        # and the next worker to run it resumes from the checkpoint.
+        with self._lock:
+            task = worker.tasks.popleft()
+            worker.preempting = False
+            task.params = { **task.params, "checkpoint": checkpoint }
+            task.preemptible = False
+            if task.cancelled is None:
+                self._pending.append(task)
+            self._dispatch()
+        if task.cancelled is not None:
+            # Cancelled while it was checkpointing; it will not resume
+            task.discard_checkpoint()
+            task.future.set_exception(JobCancelled(task.cancelled, task.discarded()))
+            return
+        task.notify("preempted", checkpoint)
+
+    def _finish(self, worker, event, payload):
+        with self._lock:
+            task = worker.tasks.popleft() if worker.tasks else None
+            worker.preempting = False
+            self._dispatch()
+        if task is None:
+            return
+        if event == "done":
+            task.future.set_result(payload)
+        elif event == "cancelled":
+            # The reason the pool asked for, if it did, over the worker's guess
+            reason = task.cancelled or payload["reason"]
+            task.discard_checkpoint()
+            task.future.set_exception(JobCancelled(reason, payload["discarded"]))
+        else:
+            task.future.set_exception(JobFailed(payload))
+
+    def _replace(self, worker):
+        worker.conn.close()
+        replacement = self._spawn(worker.index)
+        with self._lock:
+            tasks = list(worker.tasks)
+            self._workers[worker.index] = replacement
+            self._dispatch()
+        for task in tasks:
+            task.discard_checkpoint()
+            task.future.set_exception(JobFailed(f"worker exited with code {worker.process.exitcode}"))
@@ -0,0 +1,136 @@
+import os
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def cpu_quota():
+    # cgroup v2 cpu.max ("max 100000" or "200000 100000"), then v1 CFS files.
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+if hasattr(os, "sched_getaffinity"):
+    CPU_COUNT = len(os.sched_getaffinity(0))
+else:
+    CPU_COUNT = os.cpu_count() or 1
+
+# Cores the container may actually use: the smaller of the CPUs it can see and
+# its cgroup quota, rounded up so a 1.5 CPU limit still allows two threads.
+CPU_QUOTA = cpu_quota()
+CPU_LIMIT = max(1, env_int("MATRIX_CPU_LIMIT", min(CPU_COUNT, -int(-(CPU_QUOTA or CPU_COUNT) // 1))))
+
+# Number of worker processes, the BLAS threads a batch job may use, and how
+# many requests may wait for a free worker before /multiply starts refusing
+# work. Critical jobs get CRITICAL_THREADS, by default every core.
+WORKERS = max(1, env_int("MATRIX_WORKERS", min(4, CPU_LIMIT)))
+BLAS_THREADS = max(1, env_int("MATRIX_BLAS_THREADS", CPU_LIMIT // WORKERS))
+CRITICAL_THREADS = max(1, env_int("MATRIX_CRITICAL_THREADS", CPU_LIMIT))
+QUEUE_SIZE = max(0, env_int("MATRIX_QUEUE_SIZE", 2 * WORKERS))
+# Seconds of queueing that lift a waiting job by one priority class
+PRIORITY_AGING_SECONDS = env_float("MATRIX_PRIORITY_AGING_SECONDS", 30.0)
+# Queued multiplies a busy worker may hold and build operands for ahead of time
+PREFETCH_DEPTH = max(0, env_int("MATRIX_PREFETCH_DEPTH", 1))
+
+# Asynchronous jobs: how many may wait for a worker, and how long finished
+# jobs (and their results) stay in the job table.
+JOB_QUEUE_SIZE = max(0, env_int("MATRIX_JOB_QUEUE_SIZE", 10000))
+JOB_TTL = env_float("MATRIX_JOB_TTL", 600.0)
+
+
+def memory_limit_bytes():
+    # cgroup v2, then v1; an unlimited cgroup falls back to physical memory.
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value != "max" and int(value) < 1 << 60:
+            return int(value)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+# Out-of-core engine: scratch directory for memory-mapped operands, the working
+# set the tiled loop may keep in RAM, and the share of the pod's memory limit
+# one worker may use before /multiply switches to the tiled engine.
+SCRATCH_DIR = os.environ.get("MATRIX_SCRATCH_DIR") or None
+TILE_MEMORY_MB = max(1, env_int("MATRIX_TILE_MEMORY_MB", 256))
+MEMORY_LIMIT = env_int("MATRIX_MEMORY_LIMIT", memory_limit_bytes())
+WORKER_MEMORY_BUDGET = int(MEMORY_LIMIT * env_float("MATRIX_MEMORY_HEADROOM", 0.8) / WORKERS)
+
+# Uploaded operands and their products are spooled here and memory-mapped by
+# the workers; a tmpfs keeps them in page cache shared by both processes.
+SPOOL_DIR = os.environ.get("MATRIX_SPOOL_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else SCRATCH_DIR)
+
+# Operand generation: threads per worker that fill matrices in parallel, and
+# the numpy bit generator behind each stream (pcg64 or philox).
+GENERATOR_THREADS = max(1, env_int("MATRIX_GENERATOR_THREADS", BLAS_THREADS))
+BIT_GENERATOR = os.environ.get("MATRIX_BIT_GENERATOR", "pcg64").lower()
+
+# Per-worker LRU cache of explicitly seeded operands.
+OPERAND_CACHE_BYTES = env_int("MATRIX_OPERAND_CACHE_MB", min(512, WORKER_MEMORY_BUDGET // 4 // 2**20)) * 2**20
+
+# Per-worker arena of reusable, 64-byte-aligned output buffers.
+OUTPUT_ARENA_BYTES = env_int("MATRIX_OUTPUT_ARENA_MB", min(512, WORKER_MEMORY_BUDGET // 4 // 2**20)) * 2**20
+
+# What one job may use: the worker's budget less what the operand cache and
+# output arena may keep idle, so a full cache and arena plus the largest job
+# still fit. Engine choice and admission check against this.
+JOB_MEMORY_BUDGET = max(0, WORKER_MEMORY_BUDGET - OPERAND_CACHE_BYTES - OUTPUT_ARENA_BYTES)
+
+# Largest /multiply/upload body accepted; it is spooled to SPOOL_DIR, which
+# on a tmpfs counts against the pod's memory.
+MAX_UPLOAD_BYTES = env_int("MATRIX_MAX_UPLOAD_MB", JOB_MEMORY_BUDGET // 2**20) * 2**20
+
+# Total bytes of uploads and products spooled at once by concurrent requests;
+# keep it within the sizeLimit of a memory-backed SPOOL_DIR volume.
+MAX_SPOOL_BYTES = env_int("MATRIX_MAX_SPOOL_MB", JOB_MEMORY_BUDGET // 2**20) * 2**20
+
+# Largest product, in elements, /multiply/batch will return inline as JSON.
+MAX_JSON_RESULT_ELEMENTS = env_int("MATRIX_MAX_JSON_RESULT_ELEMENTS", 1_000_000)
+
+# Row blocks of a streamed product are sized to about this many MB.
+STREAM_BLOCK_MB = max(1, env_int("MATRIX_STREAM_BLOCK_MB", 8))
+
+# Strassen crossover measured at startup; reused while CPU limit, BLAS budget
+# and numpy version are unchanged.
+TUNING_FILE = os.environ.get("MATRIX_TUNING_FILE") or os.path.join(SCRATCH_DIR or "/tmp", "matrixmult-tuning.json")
+
+# Requests with a density below this run on scipy.sparse kernels; denser ones
+# run dense GEMM unless the dense operands would not fit in memory.
+SPARSE_THRESHOLD = env_float("MATRIX_SPARSE_THRESHOLD", 0.01)
+
+# A is "tall and skinny" when it has this many times more rows than the
+# larger of k and n; such products run in row blocks.
+TALL_SKINNY_RATIO = max(1, env_int("MATRIX_TALL_SKINNY_RATIO", 16))
+
+# Seconds between progress reports a worker sends for a running job
+PROGRESS_INTERVAL = max(0.0, env_float("MATRIX_PROGRESS_INTERVAL_MS", 250.0) / 1000)
+
+# Marginal power draw of one busy core, for the energy /estimate predicts
+WATTS_PER_CORE = env_float("MATRIX_WATTS_PER_CORE", 10.0)
+
+# Jobs the cost model predicts would finish more than this many seconds from
+# now, queue included, are refused; 0 only refuses jobs that would miss their
+# deadline_ms.
+ADMISSION_SECONDS = max(0.0, env_float("MATRIX_ADMISSION_SECONDS", 0.0))
@@ -0,0 +1,98 @@
+import time
+
+import numpy as np
+
+TUNING_SIZES = (256, 512, 1024, 2048, 4096)
+# Leaf size for algorithm=strassen when tuning found no crossover (yet)
+DEFAULT_CROSSOVER = 512
+
+
+def levels_for(n, crossover):
+    levels = 0
+    while n > crossover:
+        n = (n + 1) // 2
+        levels += 1
+    return levels
+
+
+def multiply(a, b, crossover):
+    # Pad once so every recursion level splits evenly, then trim.
+    n = a.shape[0]
+    step = 2 ** levels_for(n, crossover)
+    padded = -(-n // step) * step
+    if padded != n:
+        a = np.pad(a, ((0, padded - n), (0, padded - n)))
+        b = np.pad(b, ((0, padded - n), (0, padded - n)))
+    return winograd(a, b, crossover)[:n, :n]
+
+
+def winograd(a, b, crossover):
+    # Strassen-Winograd: 7 half-size products and 15 additions per level.
+    n = a.shape[0]
+    if n <= crossover:
+        return a @ b
+    h = n // 2
+    a11, a12, a21, a22 = a[:h, :h], a[:h, h:], a[h:, :h], a[h:, h:]
+    b11, b12, b21, b22 = b[:h, :h], b[:h, h:], b[h:, :h], b[h:, h:]
+
+    s1 = a21 + a22
+    s2 = s1 - a11
+    s3 = a11 - a21
+    s4 = a12 - s2
+    t1 = b12 - b11
+    t2 = b22 - t1
+    t3 = b22 - b12
+    t4 = t2 - b21
+
+    m1 = winograd(a11, b11, crossover)
+    m2 = winograd(a12, b21, crossover)
+    m3 = winograd(s4, b22, crossover)
+    m4 = winograd(a22, t4, crossover)
+    m5 = winograd(s1, t1, crossover)
+    m6 = winograd(s2, t2, crossover)
+    m7 = winograd(s3, t3, crossover)
+
+    out = np.empty((n, n), dtype=np.result_type(a, b))
+    out[:h, :h] = m1 + m2
+    u2 = m1 + m6
+    u3 = u2 + m7
+    u4 = u2 + m5
+    out[:h, h:] = u4 + m3
+    out[h:, :h] = u3 - m4
+    out[h:, h:] = u3 + m5
+    return out
+
+
+def best_time(fn, repeat=2):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def tune(dtype=np.float64, sizes=TUNING_SIZES, budget_seconds=0.5):
+    # Time BLAS against one level of Strassen-Winograd over BLAS leaves at
+    # growing sizes. The crossover is the largest leaf size at which the
+    # extra level still does not pay off, i.e. half the first size where it
+    # wins. Stops before a size whose BLAS product, scaled by n³ from the
+    # last one, would exceed the budget.
+    rng = np.random.default_rng(0)
+    blas_gflops = {}
+    speedup = {}
+    crossover = None
+    blas, last = 0.0, None
+    for n in sizes:
+        if last is not None and blas * (n / last) ** 3 > budget_seconds:
+            break
+        a = rng.random((n, n), dtype=dtype)
+        b = rng.random((n, n), dtype=dtype)
+        blas = best_time(lambda: a @ b)
+        one_level = best_time(lambda: winograd(a, b, n // 2))
+        blas_gflops[n] = 2 * n ** 3 / blas / 1e9
+        speedup[n] = blas / one_level
+        if crossover is None and speedup[n] > 1.0:
+            crossover = n // 2
+        last = n
+    return { "crossover": crossover, "blas_gflops": blas_gflops, "speedup": speedup }
@@ -0,0 +1,19 @@
+import os
+import sys
+from functools import reduce
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import chain
+
+
+def test_execute_matches_left_to_right_product():
+    dims = [5, 10, 3, 12, 5, 50, 6]
+    rng = np.random.default_rng(0)
+    matrices = [rng.random((dims[i], dims[i + 1])) for i in range(len(dims) - 1)]
+    steps, _ = chain.plan(dims)
+    product, buffers = chain.execute(matrices, steps, np.float64)
+    np.testing.assert_allclose(product, reduce(np.matmul, matrices))
+    assert buffers.reused > 0
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pool import JobCancelled, WorkerPool
+
+
+def multiply_params(size):
+    return { "m": size, "k": size, "n": size, "seed": 1, "dtype": "float64", "engine": "dense",
+             "density": None }
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(1, 1, 4)
+    pool.start()
+    return pool
+
+
+def test_cancel_right_after_submit_frees_the_worker(pool):
+    # Whether the worker has started the task or not, the future resolves;
+    # a task that beat the cancel to its end keeps its result
+    for _ in range(20):
+        future = pool.submit("multiply", multiply_params(64))
+        pool.cancel(future)
+        try:
+            future.result(timeout=30)
+        except JobCancelled as e:
+            assert e.reason == "cancelled"
+    result = pool.submit("multiply", multiply_params(8)).result(timeout=30)
+    assert result["checksum"] is not None
+    assert pool.stats()["slots_in_use"] == 0
+
+
+def test_cancel_reports_the_reason_asked_for(pool):
+    future = pool.submit("multiply", multiply_params(64))
+    pool.cancel(future, "deadline exceeded")
+    with pytest.raises(JobCancelled) as e:
+        future.result(timeout=30)
+    assert e.value.reason == "deadline exceeded"
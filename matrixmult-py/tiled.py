@@ -0,0 +1,72 @@
+import contextlib
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from control import Preempted
+
+
+def tile_size(tile_memory_bytes, itemsize=8):
+    # One tile each of A, B and the C accumulator, plus the temporary that
+    # A_tile @ B_tile produces before it is added in.
+    return max(1, int(math.sqrt(tile_memory_bytes / (4 * itemsize))))
+
+
+@contextlib.contextmanager
+def scratch_space(directory=None, resume=None):
+    # A preempted job keeps its directory, with the finished tiles in it,
+    # for the run that resumes it from there (`resume`).
+    path = resume or tempfile.mkdtemp(prefix="matrixmult-", dir=directory)
+    keep = False
+    try:
+        yield path
+    except Preempted:
+        keep = True
+        raise
+    finally:
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def scratch_matrix(directory, name, shape, dtype=np.float64):
+    return np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+
+
+def open_scratch(directory, name):
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r+")
+
+
+def blocked_matmul(a, b, out, tile, report, accumulate=np.float64, start=0, checksum=0.0, control=None):
+    # Stream t×t tiles of the memory-mapped operands through RAM, keeping one
+    # output tile resident while the k loop accumulates into it. Returns the
+    # sum of the product. Output tiles are numbered row by row; a run can
+    # start at tile `start` with the checksum of the ones before it. Between
+    # tiles, `control` may cancel the run or have it yield with a checkpoint.
+    rows, inner = a.shape
+    cols = b.shape[1]
+    col_blocks = math.ceil(cols / tile)
+    total = math.ceil(rows / tile) * col_blocks
+
+    for done in range(start, total):
+        if control is not None:
+            control.check(done, total, 2 * rows * inner * cols)
+            if done > start and control.should_yield():
+                out.flush()
+                raise Preempted({ "cursor": done, "total": total, "flops": 2 * rows * inner * cols,
+                                  "checksum": checksum })
+        i, j = (index * tile for index in divmod(done, col_blocks))
+        acc = np.zeros((min(tile, rows - i), min(tile, cols - j)), dtype=accumulate)
+        for k in range(0, inner, tile):
+            a_tile = np.asarray(a[i:i + tile, k:k + tile], dtype=accumulate)
+            b_tile = np.asarray(b[k:k + tile, j:j + tile], dtype=accumulate)
+            acc += a_tile @ b_tile
+        out[i:i + tile, j:j + tile] = acc
+        checksum += float(acc.sum(dtype=np.float64))
+        report(done=done + 1, total=total, flops=2 * rows * inner * cols * (done + 1) // total,
+               preemptible=control is not None)
+
+    out.flush()
+    return checksum
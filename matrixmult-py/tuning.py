@@ -0,0 +1,100 @@
+import json
+import logging
+import sys
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class Tuning:
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.data = None
+        self._pool = None
+
+    def start(self, pool):
+        # Reuse a tuning file from an earlier start on the same hardware,
+        # otherwise measure on a worker in the background: the Strassen
+        # crossover first, then the rest of the cost model's calibration.
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            # Files from before the cost model was calibrated are measured again
+            if saved.get("fingerprint") == self.fingerprint and "calibration" in saved:
+                self.data = saved
+                return
+        except (OSError, ValueError):
+            pass
+        self._pool = pool
+        self._submit("tune", {}, self._tuned)
+
+    def _submit(self, kind, params, done):
+        # One piece at a time and at batch priority, so work queued while a
+        # piece runs goes ahead of the next one; never refused for a full queue
+        self._pool.submit(kind, params, max_queue=sys.maxsize, priority="batch").add_done_callback(done)
+
+    def _tuned(self, future):
+        try:
+            tuned = future.result()
+        except Exception as e:
+            log.warning("strassen tuning failed: %s", e)
+            return
+        gemm = { "float64": tuned["blas_gflops"] }
+        self._submit("calibrate", { "gemm": gemm }, lambda future: self._calibrated(tuned, future))
+
+    def _calibrated(self, tuned, future):
+        try:
+            calibration = future.result()["calibration"]
+        except Exception as e:
+            log.warning("cost model calibration failed: %s", e)
+            return
+        self.data = {
+            "fingerprint": self.fingerprint,
+            "crossover": tuned["crossover"],
+            "blas_gflops": { str(n): rate for n, rate in tuned["blas_gflops"].items() },
+            "speedup": { str(n): ratio for n, ratio in tuned["speedup"].items() },
+            "calibration": json_keys(calibration),
+        }
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.data, f, indent=2)
+        except OSError as e:
+            log.warning("could not save tuning file %s: %s", self.path, e)
+
+    @property
+    def crossover(self):
+        return self.data and self.data["crossover"]
+
+    @property
+    def calibration(self):
+        return self.data and self.data.get("calibration")
+
+    def blas_gflops(self, size, compute=np.float64):
+        # Rate for products accumulated in `compute`, measured at the largest
+        # calibrated size not above `size`
+        if not self.data:
+            return None
+        rates = self.data["calibration"]["gemm_gflops"].get(np.dtype(compute).name)
+        if not rates:
+            return None
+        measured = sorted((int(n), rate) for n, rate in rates.items())
+        below = [rate for n, rate in measured if n <= size]
+        return below[-1] if below else measured[0][1]
+
+    def to_dict(self):
+        if not self.data:
+            return { "state": "pending" }
+        return { "state": "ready", **{ key: value for key, value in self.data.items() if key not in ("fingerprint", "calibration") } }
+
+
+def json_keys(value):
+    # Integer keys (sizes, byte counts) as the strings JSON will make them
+    if isinstance(value, dict):
+        return { str(key): json_keys(item) for key, item in value.items() }
+    return value
+
+
+def fingerprint(cpu_limit, blas_threads):
+    return { "cpu_limit": cpu_limit, "blas_threads": blas_threads, "numpy": np.__version__ }
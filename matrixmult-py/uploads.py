@@ -0,0 +1,121 @@
+import ast
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+NPY_MAGIC = b"\x93NUMPY"
+
+
+class SpoolFull(Exception):
+    pass
+
+
+# Bytes of uploads and products spooled at once across all requests. On a
+# tmpfs they count against the pod's memory, so each request reserves its
+# share before writing and releases it once its files are gone.
+class SpoolBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self._lock:
+            if self.bytes + nbytes > self.max_bytes:
+                raise SpoolFull(f"{self.bytes} of {self.max_bytes} spool bytes in use, {nbytes} more requested")
+            self.bytes += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            self.bytes -= nbytes
+
+
+def spool_path(directory, suffix):
+    fd, path = tempfile.mkstemp(prefix="matrixmult-", suffix=suffix, dir=directory)
+    os.close(fd)
+    return path
+
+
+def save_stream(stream, path, chunk=1 << 20):
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, chunk)
+    return os.path.getsize(path)
+
+
+def read_npy_header(f):
+    # Parse the .npy header by hand so the array data is never read here;
+    # the worker maps it straight from the file at the returned offset.
+    start = f.tell()
+    prefix = f.read(8)
+    if len(prefix) != 8 or prefix[:6] != NPY_MAGIC:
+        raise ValueError("body is not a .npy payload")
+    length_bytes = 2 if prefix[6] == 1 else 4
+    header_length = int.from_bytes(f.read(length_bytes), "little")
+    try:
+        header = ast.literal_eval(f.read(header_length).decode("latin1"))
+        layout = {
+            "dtype": np.lib.format.descr_to_dtype(header["descr"]).str,
+            "shape": tuple(int(dim) for dim in header["shape"]),
+            "fortran_order": bool(header["fortran_order"]),
+            "offset": start + 8 + length_bytes + header_length,
+        }
+    except (SyntaxError, KeyError, TypeError, ValueError, RecursionError) as e:
+        raise ValueError(f"malformed .npy header: {e}")
+    if min(layout["shape"], default=1) < 0:
+        raise ValueError("malformed .npy header: negative dimension")
+    return layout
+
+
+def npy_layouts(path):
+    # Two .npy payloads back to back: A, then B.
+    layouts = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        for name in ("first", "second"):
+            layout = read_npy_header(f)
+            end = layout["offset"] + nbytes(layout)
+            if end > size:
+                raise ValueError(f"{name} .npy payload needs {end} bytes, body has {size}")
+            f.seek(end)
+            layouts.append(layout)
+        if f.read(1):
+            raise ValueError("unexpected data after the second .npy payload")
+    return layouts
+
+
+def raw_layouts(path, dtype, shape_a, shape_b):
+    # Raw little-endian buffers back to back, shapes taken from headers.
+    dtype = np.dtype(dtype).newbyteorder("<")
+    a = { "dtype": dtype.str, "shape": shape_a, "fortran_order": False, "offset": 0 }
+    b = { "dtype": dtype.str, "shape": shape_b, "fortran_order": False, "offset": nbytes(a) }
+    if os.path.getsize(path) != nbytes(a) + nbytes(b):
+        raise ValueError(f"body has {os.path.getsize(path)} bytes, expected {nbytes(a) + nbytes(b)}")
+    return [a, b]
+
+
+def nbytes(layout):
+    return int(np.prod(layout["shape"])) * np.dtype(layout["dtype"]).itemsize
+
+
+def parse_shape(value, name):
+    try:
+        shape = tuple(int(dim) for dim in value.split(","))
+    except (AttributeError, ValueError):
+        raise ValueError(f"{name} must look like rows,cols")
+    if len(shape) != 2 or min(shape) < 1:
+        raise ValueError(f"{name} must look like rows,cols")
+    return shape
+
+
+def map_operand(path, layout):
+    return np.memmap(
+        path,
+        dtype=layout["dtype"],
+        mode="r",
+        offset=layout["offset"],
+        shape=layout["shape"],
+        order="F" if layout["fortran_order"] else "C",
+    )
@@ -0,0 +1,65 @@
+import numpy as np
+
+MAX_ROUNDS = 64
+CHUNK_ELEMENTS = 1 << 21
+
+
+def row_chunks(matrix):
+    # Row slices of about CHUNK_ELEMENTS, so memmapped operands are never
+    # widened whole
+    rows = max(1, CHUNK_ELEMENTS // max(1, matrix.shape[1]))
+    for start in range(0, matrix.shape[0], rows):
+        yield start, matrix[start:start + rows]
+
+
+def tolerance(inner, accumulate, stored):
+    # Rounding of an inner-length dot product plus that of storing C,
+    # relative to |A|·|B|, with some slack
+    return 4 * (inner * np.finfo(accumulate).eps + np.finfo(stored).eps)
+
+
+# Freivalds' check of C = A·B: for a random 0/1 vector r, A·(B·r) must
+# equal C·r. Each round costs O(n²) and misses a wrong product with
+# probability at most 1/2, so k rounds are fooled at most 2^-k of the time.
+# Rows of A and C can be fed in blocks, as the row-block engines produce
+# them; dense, memmapped and scipy.sparse operands all work.
+class Freivalds:
+    def __init__(self, b, rounds, accumulate=np.float64):
+        # Fresh entropy: whoever computed C must not be able to predict r
+        rng = np.random.default_rng()
+        self.rounds = rounds
+        self.inner = b.shape[0]
+        self.r = rng.integers(0, 2, size=(b.shape[1], rounds)).astype(np.float64)
+        self.br = np.empty((b.shape[0], rounds))
+        self.abs_br = np.empty((b.shape[0], rounds))
+        for start, rows in row_chunks(b):
+            rows = rows.astype(np.float64)
+            self.br[start:start + rows.shape[0]] = rows @ self.r
+            self.abs_br[start:start + rows.shape[0]] = abs(rows) @ self.r
+        self.accumulate = accumulate
+        self.worst = np.zeros(rounds)
+
+    def check(self, a, c):
+        # Rows of A and the matching rows of C
+        for start, a_rows in row_chunks(a):
+            a_rows = a_rows.astype(np.float64)
+            c_rows = c[start:start + a_rows.shape[0]].astype(np.float64)
+            error = abs(c_rows @ self.r - a_rows @ self.br)
+            bound = abs(a_rows) @ self.abs_br
+            relative = error / np.maximum(bound, np.finfo(np.float64).tiny)
+            # NaN in C must fail the check, not slip past the comparison
+            relative = np.nan_to_num(relative, nan=np.inf)
+            self.worst = np.maximum(self.worst, relative.max(axis=0, initial=0.0))
+
+    def result(self, stored):
+        limit = tolerance(self.inner, self.accumulate, stored)
+        failed = int((self.worst > limit).sum())
+        return {
+            "method": "freivalds",
+            "rounds": self.rounds,
+            "passed": failed == 0,
+            "failed_rounds": failed,
+            "max_relative_error": float(self.worst.max(initial=0.0)),
+            "tolerance": float(limit),
+            "false_pass_probability": 0.5 ** self.rounds if failed == 0 else 0.0,
+        }